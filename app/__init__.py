@@ -1,11 +1,60 @@
 from flask import Flask, jsonify
 from flask_cors import CORS
 
-def create_app():
+from app.compression import COMPRESSIBLE_MIMETYPES
+
+def create_app(config=None):
     app = Flask(__name__)
     app.config['JSON_SORT_KEYS'] = False
+    app.config['USER_STORAGE'] = 'json'
+    app.config['USER_DATA_PATH'] = None
+    app.config['USER_COMPACT_RECORDS'] = False
+    app.config['METRICS_ENABLED'] = True
+    app.config['METRICS_SLOW_REQUEST_MS'] = None
+    app.config['QUERY_CACHE_SIZE'] = 256
+    app.config['QUERY_CACHE_TTL'] = 30.0
+    app.config['CHANGES_POLL_INTERVAL'] = 0.5
+    app.config['CHANGES_STREAM_TIMEOUT'] = 300
+    app.config['JSON_COMPACT'] = True
+    app.config['COMPRESSION_ENABLED'] = True
+    app.config['COMPRESSION_MIN_SIZE'] = 500
+    app.config['COMPRESSION_LEVEL'] = 6
+    app.config['COMPRESSION_MIMETYPES'] = COMPRESSIBLE_MIMETYPES
+    app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+    app.config['JSON_FRAGMENT_CACHE_SIZE'] = 10000
+    app.config['ADMISSION_ENABLED'] = True
+    app.config['ADMISSION_POLICIES'] = None
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
     CORS(app)
     
+    from app import metrics
+    metrics.init_app(app)
+    # None keeps Flask's default of indenting in debug mode only
+    app.json.compact = app.config['JSON_COMPACT']
+    
+    from app import admission
+    admission.init_app(app)
+    
+    from app import compression
+    compression.init_app(app)
+    
+    from app import assets
+    assets.init_app(app)
+    
+    from app.models import UserDatabase
+    UserDatabase.init_app(app)
+    
+    from app.cache import QueryCache
+    if app.config['QUERY_CACHE_SIZE']:
+        app.extensions['query_cache'] = QueryCache(app.config['QUERY_CACHE_SIZE'],
+                                                   app.config['QUERY_CACHE_TTL'])
+    
+    from app.fragments import FragmentCache
+    if app.config['JSON_FRAGMENT_CACHE_SIZE']:
+        app.extensions['json_fragments'] = FragmentCache(app.config['JSON_FRAGMENT_CACHE_SIZE'])
+    
     from app.api import api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
     
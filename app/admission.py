@@ -0,0 +1,230 @@
+"""Admission control: per-route concurrency limits with bounded wait queues.
+
+Every API request belongs to a route class (``read``, ``write``,
+``export`` or ``stream``) with its own limit on concurrent requests.
+Requests over the limit wait in a queue of at most ``queue`` requests for
+up to ``timeout`` seconds. A request that finds the queue full is rejected at once with 429,
+and one that is still queued at its deadline gets 503; both carry
+``Retry-After``. Exports also wait while any write is queued, so bulk
+exports cannot hold writes back. Change streams never queue: past their
+limit they are rejected, since each one holds a thread for minutes.
+
+Requests also queue before they reach the app, in the listen backlog or a
+proxy. When the proxy stamps requests with ``X-Request-Start`` (``t=`` and
+a Unix time in seconds, milliseconds or microseconds, as nginx and most
+routers send it) that wait counts against the deadline. A request that has
+already used up its ``timeout`` is shed without queueing.
+
+Limits are per worker process and only engage when a worker handles
+several requests at once, e.g. gunicorn's ``gthread`` workers with
+``--threads`` above the sum of the limits. A sync worker serves one request
+at a time, so there it never has anything to queue. ``/metrics`` and the
+dashboard are never queued.
+"""
+import math
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+from app import metrics
+
+DEFAULT_POLICIES = {
+    'read': {'limit': 16, 'queue': 64, 'timeout': 2.0, 'retry_after': 1},
+    'write': {'limit': 4, 'queue': 64, 'timeout': 5.0, 'retry_after': 1},
+    'export': {'limit': 2, 'queue': 4, 'timeout': 10.0, 'retry_after': 5, 'yields_to': ('write',)},
+    # Each open change stream holds a thread for CHANGES_STREAM_TIMEOUT
+    'stream': {'limit': 4, 'queue': 0, 'timeout': 1.0, 'retry_after': 30},
+}
+
+# Endpoints that are not classified by method
+ROUTE_CLASSES = {
+    'api.export_users': 'export',
+    'api.stream_changes': 'stream',
+}
+
+
+class AdmissionController:
+    """Concurrency limits and wait queues for a set of route classes"""
+
+    def __init__(self, policies, record_metrics=True):
+        self.policies = policies
+        # Slots may be released after the app context is gone (streamed bodies)
+        self.record_metrics = record_metrics
+        self.active = dict.fromkeys(policies, 0)
+        self.waiting = dict.fromkeys(policies, 0)
+        self.checked_server = False
+        self._cond = threading.Condition()
+
+    def _can_run(self, name):
+        policy = self.policies[name]
+        return (self.active[name] < policy['limit']
+                and not any(self.waiting[other] for other in policy.get('yields_to', ())))
+
+    def _update_gauges(self, name):
+        if not self.record_metrics:
+            return
+        metrics.ADMISSION_QUEUE.set((name,), self.waiting[name])
+        metrics.ADMISSION_IN_FLIGHT.set((name,), self.active[name])
+
+    def acquire(self, name, timeout=None):
+        """Take a slot of class ``name``.
+
+        Returns ``'admitted'`` or ``'queued'`` once the request holds a slot,
+        or ``'rejected'`` (queue full), ``'timeout'`` or ``'expired'`` (no
+        time left to wait at all) without one.
+        """
+        policy = self.policies[name]
+        timeout = policy['timeout'] if timeout is None else timeout
+        if timeout <= 0:
+            return 'expired'
+        with self._cond:
+            # Arrivals do not overtake requests that are already queued
+            if not self.waiting[name] and self._can_run(name):
+                self.active[name] += 1
+                self._update_gauges(name)
+                return 'admitted'
+            if self.waiting[name] >= policy['queue']:
+                return 'rejected'
+            self.waiting[name] += 1
+            self._update_gauges(name)
+            start = time.monotonic()
+            deadline = start + timeout
+            try:
+                while not self._can_run(name):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self._cond.wait(remaining)
+                self.active[name] += 1
+                return 'queued'
+            finally:
+                self.waiting[name] -= 1
+                self._update_gauges(name)
+                if self.record_metrics:
+                    metrics.ADMISSION_WAIT_SECONDS.observe((name,), time.monotonic() - start)
+                # Classes yielding to this one may be able to run now
+                self._cond.notify_all()
+
+    def release(self, name):
+        with self._cond:
+            self.active[name] -= 1
+            self._update_gauges(name)
+            self._cond.notify_all()
+
+
+def route_class(endpoint, method):
+    """The route class of a request, or None when it is not admission controlled"""
+    if not endpoint or not endpoint.startswith('api.') or method == 'OPTIONS':
+        return None
+    if endpoint in ROUTE_CLASSES:
+        return ROUTE_CLASSES[endpoint]
+    return 'read' if method in ('GET', 'HEAD') else 'write'
+
+
+def upstream_wait(value, now=None):
+    """Seconds since an ``X-Request-Start`` timestamp, or 0 if there is none"""
+    if not value:
+        return 0.0
+    try:
+        stamp = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return 0.0
+    # Microseconds, milliseconds or seconds since the epoch
+    if stamp > 1e14:
+        stamp /= 1e6
+    elif stamp > 1e11:
+        stamp /= 1e3
+    return max(0.0, (time.time() if now is None else now) - stamp)
+
+
+def overloaded(status, message, retry_after):
+    """A 429/503 error response asking the client to retry later"""
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def _admit():
+    name = route_class(request.endpoint, request.method)
+    if name is None:
+        return None
+    controller = current_app.extensions['admission']
+    if not controller.checked_server:
+        controller.checked_server = True
+        if not request.environ.get('wsgi.multithread') and not current_app.testing:
+            current_app.logger.warning(
+                'Admission control needs a threaded server (e.g. gunicorn --threads 32); '
+                'this worker handles one request at a time, so its limits never apply')
+    waited = upstream_wait(request.headers.get('X-Request-Start'))
+    start = time.perf_counter()
+    decision = controller.acquire(name, controller.policies[name]['timeout'] - waited)
+    if controller.record_metrics:
+        metrics.ADMISSIONS.inc((name, decision))
+        if decision == 'queued':
+            metrics.record_phase('admission.wait', time.perf_counter() - start)
+    retry_after = controller.policies[name]['retry_after']
+    if decision == 'rejected':
+        return overloaded(429, f'Too many {name} requests queued, retry later', retry_after)
+    if decision in ('timeout', 'expired'):
+        return overloaded(503, f'Timed out waiting to handle the {name} request, retry later',
+                          retry_after)
+    g.admission_class = name
+    return None
+
+
+class _HeldBody:
+    """A streamed body that releases its admission slot when done or closed"""
+
+    def __init__(self, chunks, controller, name):
+        self.chunks = chunks
+        self.controller = controller
+        self.name = name
+
+    def __iter__(self):
+        try:
+            yield from self.chunks
+        finally:
+            self.close()
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.release(self.name)
+            self.controller = None
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+
+
+def _hold_for_stream(response):
+    # A streamed body (exports) keeps its slot until it has been sent in
+    # full or the client went away
+    name = g.get('admission_class')
+    if name is not None and response.is_streamed:
+        g.admission_class = None
+        response.response = _HeldBody(response.response, current_app.extensions['admission'], name)
+    return response
+
+
+def _release(exc):
+    name = g.pop('admission_class', None)
+    if name is not None:
+        current_app.extensions['admission'].release(name)
+
+
+def init_app(app):
+    """Install admission control unless ADMISSION_ENABLED is false.
+
+    ``ADMISSION_POLICIES`` maps route classes to settings that override
+    ``DEFAULT_POLICIES``.
+    """
+    if not app.config['ADMISSION_ENABLED']:
+        return
+    overrides = app.config['ADMISSION_POLICIES'] or {}
+    policies = {name: {**policy, **overrides.get(name, {})}
+                for name, policy in DEFAULT_POLICIES.items()}
+    app.extensions['admission'] = AdmissionController(policies, metrics.enabled(app))
+    app.before_request(_admit)
+    app.after_request(_hold_for_stream)
+    app.teardown_request(_release)
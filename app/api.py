@@ -1,12 +1,69 @@
-from flask import Blueprint, request, jsonify
-import csv
+import itertools
 import json
-from io import StringIO
-from flask import Response
-from app.models import User, UserDatabase
+import sqlite3
+import time
+from flask import Blueprint, current_app, request, jsonify
+from flask import Response, stream_with_context
+from app import metrics
+from app.admission import overloaded
+from app.fragments import jsonify_listing, jsonify_user
+from app.formats import EXPORT_FORMATS, gzip_stream, iter_import_rows, parse_fields, parse_items
+from app.models import (SORTABLE_FIELDS, ChangeLogGoneError, DuplicateEmailError, InvalidCursorError,
+                        PreconditionFailedError, User, UserDatabase)
 
 api_bp = Blueprint('api', __name__)
 
+BULK_MAX_ITEMS = 10000
+IMPORT_MAX_CHUNK = 10000
+CHANGES_MAX_LIMIT = 10000
+CHANGES_HEARTBEAT = 15.0
+
+def _server_error(e):
+    """Log and count an unexpected exception, and report it as a 500"""
+    if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+        # SQLite gave up waiting for another writer: overload, not a bug
+        metrics.record_error(e)
+        return overloaded(503, 'The database is busy, retry later', 1)
+    current_app.logger.exception('Error handling %s %s', request.method, request.path)
+    metrics.record_error(e)
+    return jsonify({'error': str(e)}), 500
+
+def _listing_key(search, page, limit, sort_by, order, cursor):
+    """Query cache key; parameters that give the same listing map to the same key"""
+    return (search.lower(), page, limit, sort_by if sort_by in SORTABLE_FIELDS else '',
+            'desc' if order.lower() == 'desc' else 'asc', cursor)
+
+def _not_modified(etag, last_modified=None):
+    """Return a 304 response if the client's copy is still current, else None"""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        # Last-Modified has one-second resolution, so a write within the
+        # same second as the client's copy would go unnoticed until the
+        # last write is at least a second old (RFC 7232, 2.2.2)
+        fresh = (time.time() - last_modified >= 1
+                 and int(last_modified) <= request.if_modified_since.timestamp())
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    return _with_validators(Response(status=304), etag, last_modified)
+
+def _with_validators(response, etag, last_modified=None):
+    # Always revalidate; without this browsers may reuse a stale listing
+    # based on Last-Modified alone
+    response.cache_control.no_cache = True
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = int(last_modified)
+    return response
+
+def _if_match():
+    """The strong ETags listed in If-Match, or None when any version is acceptable"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return request.if_match.as_set()
+
 @api_bp.route('/users', methods=['GET'])
 def get_users():
     """
@@ -17,6 +74,8 @@ def get_users():
     - limit: items per page (default 10)
     - sort_by: sort field (id, name, email, role) (default id)
     - order: asc or desc (default asc)
+    - cursor: opaque keyset cursor; pass it (empty for the first page) to
+      page with next_cursor instead of page numbers
     """
     try:
         search = request.args.get('search', '')
@@ -24,14 +83,110 @@ def get_users():
         limit = int(request.args.get('limit', 10))
         sort_by = request.args.get('sort_by', 'id')
         order = request.args.get('order', 'asc')
+        cursor = request.args.get('cursor')
         
         if page < 1 or limit < 1:
             return jsonify({'error': 'Page and limit must be positive integers'}), 400
         
-        result = UserDatabase.get_users(search, page, limit, sort_by, order)
-        return jsonify(result)
+        # The data tag changes on any write or reload, so it validates every listing
+        version = UserDatabase.data_version()
+        tag = UserDatabase.data_tag()
+        etag = f'v{tag}'
+        last_modified = UserDatabase.last_modified()
+        not_modified = _not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+        
+        cache = current_app.extensions.get('query_cache')
+        key = _listing_key(search, page, limit, sort_by, order, cursor)
+        body = cache.get(tag, key) if cache is not None else None
+        if body is None:
+            response = jsonify_listing(UserDatabase.get_users(search, page, limit, sort_by, order, cursor))
+            if cache is not None:
+                cache.put(tag, key, response.get_data())
+        else:
+            response = current_app.response_class(body, mimetype=current_app.json.mimetype)
+        # The version to follow /users/changes from
+        response.headers['X-Data-Version'] = str(version)
+        return _with_validators(response, etag, last_modified)
+    except InvalidCursorError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return _server_error(e)
+
+@api_bp.route('/users/changes', methods=['GET'])
+def get_changes():
+    """
+    Writes made after a data version (the X-Data-Version of a listing)
+    Query params:
+    - since: data version to start after (required)
+    - limit: maximum number of changes (default 1000)
+    Responds 410 when the changes are no longer available; reload the list.
+    """
+    try:
+        try:
+            since = int(request.args['since'])
+            limit = int(request.args.get('limit', 1000))
+        except (KeyError, ValueError):
+            return jsonify({'error': 'since must be given as an integer data version'}), 400
+        if since < 0 or limit < 1:
+            return jsonify({'error': 'since and limit must not be negative'}), 400
+        return jsonify(UserDatabase.get_changes(since, min(limit, CHANGES_MAX_LIMIT))), 200
+    except ChangeLogGoneError as e:
+        return jsonify({'error': str(e), 'version': UserDatabase.data_version()}), 410
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
+
+def _change_events(since, poll_interval, timeout):
+    """Server-sent events for every write after ``since``, polling the store"""
+    deadline = time.monotonic() + timeout
+    last_sent = time.monotonic()
+    yield f'event: ready\ndata: {json.dumps({"version": since})}\n\n'
+    while True:
+        try:
+            result = UserDatabase.get_changes(since, CHANGES_MAX_LIMIT)
+        except ChangeLogGoneError as e:
+            payload = {'error': str(e), 'version': UserDatabase.data_version()}
+            yield f'event: reset\ndata: {json.dumps(payload)}\n\n'
+            return
+        now = time.monotonic()
+        if result['changes']:
+            yield ''.join(f'id: {c["seq"]}\ndata: {json.dumps(c)}\n\n' for c in result['changes'])
+            since = result['version']
+            last_sent = now
+            if result['has_more']:
+                continue
+        elif now - last_sent >= CHANGES_HEARTBEAT:
+            yield ': keepalive\n\n'
+            last_sent = now
+        if now >= deadline:
+            return
+        time.sleep(poll_interval)
+
+@api_bp.route('/users/changes/stream', methods=['GET'])
+def stream_changes():
+    """
+    Server-sent events stream of changes
+    Query params:
+    - since: data version to start after (default: the current version);
+      a reconnecting EventSource sends Last-Event-ID instead
+    Each change is one event whose id is its data version. A ``reset``
+    event means the client must reload the list. The stream ends after
+    CHANGES_STREAM_TIMEOUT seconds and EventSource reconnects. Every open
+    stream holds a worker thread; admission control caps them per process.
+    """
+    try:
+        since = request.headers.get('Last-Event-ID') or request.args.get('since')
+        try:
+            since = UserDatabase.data_version() if since is None else int(since)
+        except ValueError:
+            return jsonify({'error': 'since must be an integer data version'}), 400
+        events = _change_events(since, current_app.config['CHANGES_POLL_INTERVAL'],
+                                current_app.config['CHANGES_STREAM_TIMEOUT'])
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    except Exception as e:
+        return _server_error(e)
 
 @api_bp.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
@@ -40,9 +195,14 @@ def get_user(user_id):
         user = UserDatabase.get_user_by_id(user_id)
         if not user:
             return jsonify({'error': f'User {user_id} not found'}), 404
-        return jsonify(user), 200
+        etag = UserDatabase.user_etag(user)
+        last_modified = UserDatabase.last_modified()
+        not_modified = _not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+        return _with_validators(jsonify_user(user), etag, last_modified), 200
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
 
 @api_bp.route('/users', methods=['POST'])
 def create_user():
@@ -61,9 +221,11 @@ def create_user():
             email=data['email'],
             role=data['role']
         )
-        return jsonify(user), 201
+        return _with_validators(jsonify(user), UserDatabase.user_etag(user)), 201
+    except DuplicateEmailError as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
 
 @api_bp.route('/users/<int:user_id>', methods=['PUT'])
 def update_user(user_id):
@@ -95,51 +257,174 @@ def update_user(user_id):
             user_id,
             name=data.get('name'),
             email=data.get('email'),
-            role=data.get('role')
+            role=data.get('role'),
+            if_match=_if_match()
         )
-        return jsonify(user), 200
+        if not user:
+            return jsonify({'error': f'User {user_id} not found'}), 404
+        return _with_validators(jsonify(user), UserDatabase.user_etag(user)), 200
+    except DuplicateEmailError as e:
+        return jsonify({'error': str(e)}), 409
+    except PreconditionFailedError as e:
+        return jsonify({'error': str(e)}), 412
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
 
 @api_bp.route('/users/<int:user_id>', methods=['DELETE'])
 def delete_user(user_id):
     """Delete a user"""
     try:
-        existing_user = UserDatabase.get_user_by_id(user_id)
-        if not existing_user:
+        if not UserDatabase.delete_user(user_id, if_match=_if_match()):
             return jsonify({'error': f'User {user_id} not found'}), 404
-        
-        UserDatabase.delete_user(user_id)
         return jsonify({'message': 'User deleted successfully'}), 200
+    except PreconditionFailedError as e:
+        return jsonify({'error': str(e)}), 412
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
+
+def _bulk(operation, success_status):
+    """
+    Run a bulk operation over the items in the request body
+    Query params:
+    - atomic: true to apply all items or none (default false, best effort)
+    """
+    try:
+        try:
+            items = parse_items(request.get_data(), request.content_type)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not items:
+            return jsonify({'error': 'Request body must contain at least one item'}), 400
+        if len(items) > BULK_MAX_ITEMS:
+            return jsonify({'error': f'At most {BULK_MAX_ITEMS} items per request'}), 413
+        atomic = request.args.get('atomic', 'false').lower() in ('1', 'true', 'yes')
+        
+        results = []
+        for index, (status, value) in enumerate(operation(items, atomic)):
+            if status >= 400:
+                results.append({'index': index, 'status': status, 'error': value})
+            else:
+                results.append({'index': index, 'status': status, 'user': value})
+        failed = sum(1 for r in results if r['status'] >= 400)
+        applied = not (atomic and failed)
+        
+        body = {
+            'results': results,
+            'succeeded': len(results) - failed if applied else 0,
+            'failed': failed,
+            'applied': applied
+        }
+        if not failed:
+            return jsonify(body), success_status
+        return jsonify(body), 207 if applied else 400
+    except Exception as e:
+        return _server_error(e)
+
+@api_bp.route('/users/bulk', methods=['POST'])
+def bulk_create_users():
+    """Create many users from a JSON array or NDJSON body"""
+    return _bulk(UserDatabase.bulk_create, 201)
+
+@api_bp.route('/users/bulk', methods=['PATCH'])
+def bulk_update_users():
+    """Update many users; every item needs an id plus the fields to change"""
+    return _bulk(UserDatabase.bulk_update, 200)
+
+@api_bp.route('/users/bulk', methods=['DELETE'])
+def bulk_delete_users():
+    """Delete many users given as ids or objects with an id"""
+    return _bulk(UserDatabase.bulk_delete, 200)
+
+@api_bp.route('/users/import', methods=['POST'])
+def import_users():
+    """
+    Import users from a streamed CSV or NDJSON upload
+    The body is read incrementally (raw, or as a multipart "file" field).
+    Query params:
+    - format: csv or ndjson (default: from the Content-Type or file name, else csv)
+    - chunk_size: rows per commit (default 1000)
+    """
+    try:
+        chunk_size = int(request.args.get('chunk_size', 1000))
+        if not 1 <= chunk_size <= IMPORT_MAX_CHUNK:
+            return jsonify({'error': f'chunk_size must be between 1 and {IMPORT_MAX_CHUNK}'}), 400
+        
+        format = request.args.get('format', '').lower()
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({'error': 'Multipart uploads need a "file" field'}), 400
+            stream, hint = upload.stream, upload.filename or ''
+        else:
+            stream, hint = request.stream, request.mimetype
+        if not format:
+            format = 'ndjson' if 'json' in hint.lower() else 'csv'
+        if format not in ('csv', 'ndjson'):
+            return jsonify({'error': 'Format must be csv or ndjson'}), 400
+        
+        try:
+            rows = iter_import_rows(stream, format)
+            first = next(rows, None)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if first is not None:
+            rows = itertools.chain([first], rows)
+        
+        def progress(summary):
+            current_app.logger.info('Import: %d rows processed, %d failed, %d chunks committed',
+                                    summary['processed'], summary['failed'], summary['chunks'])
+        
+        summary = UserDatabase.import_users(rows, chunk_size, on_chunk=progress)
+        if 'error' in summary:
+            return jsonify(summary), 400
+        return jsonify(summary), 207 if summary['failed'] else 200
+    except Exception as e:
+        return _server_error(e)
 
 @api_bp.route('/users/export', methods=['GET'])
 def export_users():
-    """Export users to CSV or JSON"""
+    """
+    Stream all users as CSV, JSON or NDJSON
+    Query params:
+    - format: csv, json or ndjson (default json)
+    - fields: comma-separated subset of id,name,email,role (default all)
+    - compress: gzip to compress on the fly (also used when the client
+      sends Accept-Encoding: gzip)
+    - compact: true for JSON without indentation
+    """
     try:
         format = request.args.get('format', 'json').lower()
+        if format not in EXPORT_FORMATS:
+            return jsonify({'error': 'Format must be csv, json or ndjson'}), 400
+        try:
+            fields = parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        users = UserDatabase.load_data()
+        encode, mimetype, filename = EXPORT_FORMATS[format]
+        compress = request.args.get('compress', '').lower()
+        gzip = compress == 'gzip' or (not compress and bool(request.accept_encodings['gzip']))
         
-        if format == 'csv':
-            output = StringIO()
-            writer = csv.DictWriter(output, fieldnames=['id', 'name', 'email', 'role'])
-            writer.writeheader()
-            writer.writerows(users)
-            
-            return Response(
-                output.getvalue(),
-                mimetype='text/csv',
-                headers={'Content-Disposition': 'attachment; filename=users.csv'}
-            )
-        elif format == 'json':
-            return Response(
-                json.dumps(users, indent=2),
-                mimetype='application/json',
-                headers={'Content-Disposition': 'attachment; filename=users.json'}
-            )
+        compact = format == 'json' and request.args.get('compact', '').lower() in ('1', 'true')
+        
+        etag = f'v{UserDatabase.data_tag()}' + ('-compact' if compact else '') + ('-gzip' if gzip else '')
+        last_modified = UserDatabase.last_modified()
+        not_modified = _not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+        
+        # iter_all reads from a snapshot, so later writes do not affect an
+        # export that is already streaming
+        if compact:
+            chunks = encode(UserDatabase.store().iter_all(), fields, compact=True)
         else:
-            return jsonify({'error': 'Format must be csv or json'}), 400
+            chunks = encode(UserDatabase.store().iter_all(), fields)
+        headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+        if gzip:
+            chunks = gzip_stream(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        
+        response = Response(chunks, mimetype=mimetype, headers=headers)
+        return _with_validators(response, etag, last_modified)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _server_error(e)
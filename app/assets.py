@@ -0,0 +1,111 @@
+"""Fingerprinted, precompressed static assets.
+
+At startup every file under ``app/static`` is read once, hashed and
+gzip-compressed in memory. Templates link to ``asset_url('js/app.js')``,
+which gives ``/assets/js/app.<hash>.js``. Because the URL changes whenever
+the content does, those responses are cached by browsers and proxies for
+ASSET_MAX_AGE seconds without revalidation.
+"""
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+
+from flask import Blueprint, Response, abort, current_app, request, url_for
+
+from app.compression import COMPRESSIBLE_MIMETYPES, compress
+
+assets_bp = Blueprint('assets', __name__)
+
+
+class Asset:
+    __slots__ = ('path', 'digest', 'mimetype', 'data', 'gzipped', 'mtime_ns')
+
+    def __init__(self, path, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+        self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            self.data = f.read()
+        self.digest = hashlib.sha256(self.data).hexdigest()[:12]
+        self.gzipped = None
+        if self.mimetype in COMPRESSIBLE_MIMETYPES:
+            gzipped = compress(self.data, 'gzip', 9)
+            if len(gzipped) < len(self.data):
+                self.gzipped = gzipped
+
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime_ns
+        except FileNotFoundError:
+            return False
+
+
+def _fingerprinted(filename, digest):
+    stem, dot, suffix = filename.rpartition('.')
+    return f'{stem}.{digest}.{suffix}' if dot else f'{filename}.{digest}'
+
+
+class AssetManifest:
+    """Map static filenames to their fingerprinted names and content"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._assets = {}
+        self._by_url = {}
+        for path in sorted(self.root.rglob('*')):
+            if path.is_file():
+                filename = path.relative_to(self.root).as_posix()
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                asset = self._assets[filename] = Asset(path, mimetype)
+                self._by_url[_fingerprinted(filename, asset.digest)] = asset
+
+    def url_name(self, filename, reload=False):
+        asset = self._assets[filename]
+        if reload and asset.is_stale():
+            # Debug mode: pick up edits without a restart
+            del self._by_url[_fingerprinted(filename, asset.digest)]
+            asset.load()
+            self._by_url[_fingerprinted(filename, asset.digest)] = asset
+        return _fingerprinted(filename, asset.digest)
+
+    def get(self, url_name):
+        return self._by_url.get(url_name)
+
+
+def asset_url(filename):
+    """URL of the fingerprinted copy of a file under ``app/static``"""
+    manifest = current_app.extensions['assets']
+    return url_for('assets.asset', filename=manifest.url_name(filename, reload=current_app.debug))
+
+
+@assets_bp.route('/assets/<path:filename>')
+def asset(filename):
+    found = current_app.extensions['assets'].get(filename)
+    if found is None:
+        abort(404)
+    if request.if_none_match.contains_weak(found.digest):
+        response = Response(status=304)
+    else:
+        gzip = found.gzipped is not None and bool(request.accept_encodings['gzip'])
+        response = Response(found.gzipped if gzip else found.data, mimetype=found.mimetype)
+        if gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    if found.gzipped is not None:
+        response.vary.add('Accept-Encoding')
+    # Weak: the gzipped and plain bodies share it
+    response.set_etag(found.digest, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['ASSET_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Fingerprint the static files and register ``/assets`` and ``asset_url``"""
+    app.extensions['assets'] = AssetManifest(app.static_folder)
+    app.register_blueprint(assets_bp)
+    app.add_template_global(asset_url)
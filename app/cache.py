@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import CACHE_EVENTS
+
+
+class QueryCache:
+    """Bounded LRU cache of serialized listing responses.
+
+    Entries belong to one data tag: looking up under a different tag drops
+    everything cached for the old one, so any write or reload (in any
+    worker) invalidates the cache. Entries also expire after
+    ``ttl`` seconds, and values larger than ``max_value_bytes`` (huge
+    ``limit`` pages) are not cached at all. Hits, misses, evictions and
+    expirations are counted in ``app_query_cache_events_total``.
+    """
+
+    def __init__(self, max_entries=256, ttl=30.0, max_value_bytes=1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_value_bytes = max_value_bytes
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _switch_version(self, version):
+        if version != self.version:
+            if self._entries:
+                CACHE_EVENTS.inc(('invalidated',), len(self._entries))
+                self._entries.clear()
+            self.version = version
+
+    def get(self, version, key):
+        """Return the cached value for ``key`` at data tag ``version``, or None"""
+        with self._lock:
+            self._switch_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    CACHE_EVENTS.inc(('hit',))
+                    return value
+                del self._entries[key]
+                CACHE_EVENTS.inc(('expired',))
+        CACHE_EVENTS.inc(('miss',))
+        return None
+
+    def put(self, version, key, value):
+        if len(value) > self.max_value_bytes:
+            return
+        with self._lock:
+            # Tags are not ordered. Another tag means a request has seen
+            # other (most likely newer) data since this value was built.
+            if self.version is not None and version != self.version:
+                return
+            self.version = version
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                CACHE_EVENTS.inc(('eviction',))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,76 @@
+"""gzip/deflate compression of finished responses.
+
+Responses are compressed when the client accepts it, the body is at least
+COMPRESSION_MIN_SIZE bytes and the mimetype is in COMPRESSION_MIMETYPES.
+Streamed responses (exports compress themselves as they stream), bodies
+that already carry a Content-Encoding, and ``Cache-Control: no-transform``
+responses are passed through untouched.
+"""
+import zlib
+
+from flask import request
+
+from app import metrics
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+)
+
+# zlib wbits for each Content-Encoding: 31 adds a gzip header, 15 a zlib one
+_WBITS = {'gzip': 31, 'deflate': 15}
+
+
+def compress(data, encoding, level=6):
+    """Compress bytes for the ``gzip`` or ``deflate`` Content-Encoding"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def choose_encoding(accept_encodings):
+    """The client's preferred encoding among gzip and deflate, or None"""
+    best = None
+    for encoding in ('gzip', 'deflate'):
+        quality = accept_encodings[encoding]
+        if quality and (best is None or quality > accept_encodings[best]):
+            best = encoding
+    return best
+
+
+def _compress_response(response, config):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESSION_MIMETYPES']
+            or response.cache_control.no_transform):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None or request.method == 'HEAD':
+        return response
+    data = response.get_data()
+    if len(data) < config['COMPRESSION_MIN_SIZE']:
+        return response
+    with metrics.span('compress'):
+        response.set_data(compress(data, encoding, config['COMPRESSION_LEVEL']))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is a different representation: a weak ETag still
+    # validates conditional GETs but never matches If-Match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Compress responses after every request unless COMPRESSION_ENABLED is false"""
+    if not app.config['COMPRESSION_ENABLED']:
+        return
+    config = app.config
+    app.after_request(lambda response: _compress_response(response, config))
@@ -0,0 +1,155 @@
+import csv
+import io
+import json
+import zlib
+from io import StringIO
+
+EXPORT_FIELDS = ['id', 'name', 'email', 'role']
+CHUNK_ROWS = 1000
+
+
+def parse_fields(value):
+    """Parse a comma-separated ``fields`` parameter; None selects every field"""
+    if not value:
+        return list(EXPORT_FIELDS)
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in EXPORT_FIELDS]
+    if unknown or not fields:
+        raise ValueError('Unknown fields: %s (choose from %s)' % (
+            ', '.join(unknown) or value, ', '.join(EXPORT_FIELDS)))
+    return fields
+
+
+def _project(users, fields):
+    if fields == EXPORT_FIELDS:
+        return users
+    return ({f: u[f] for f in fields} for u in users)
+
+
+def iter_json(users, fields=EXPORT_FIELDS, chunk_rows=CHUNK_ROWS, compact=False):
+    """Yield the same text as ``json.dumps(users, indent=2)``, a chunk at a time.
+
+    With ``compact`` the text matches ``json.dumps(users, separators=(',', ':'))``.
+    """
+    if compact:
+        dumps = json.JSONEncoder(separators=(',', ':')).encode
+        opening, separator, closing = '[', ',', ']'
+    else:
+        dumps = lambda u: json.dumps(u, indent=2).replace('\n', '\n  ')
+        opening, separator, closing = '[\n  ', ',\n  ', '\n]'
+    parts = []
+    first = True
+    for u in _project(users, fields):
+        parts.append((opening if first else separator) + dumps(u))
+        first = False
+        if len(parts) >= chunk_rows:
+            yield ''.join(parts)
+            parts = []
+    parts.append('[]' if first else closing)
+    yield ''.join(parts)
+
+
+def iter_ndjson(users, fields=EXPORT_FIELDS, chunk_rows=CHUNK_ROWS):
+    """Yield one compact JSON object per line"""
+    parts = []
+    for u in _project(users, fields):
+        parts.append(json.dumps(u) + '\n')
+        if len(parts) >= chunk_rows:
+            yield ''.join(parts)
+            parts = []
+    if parts:
+        yield ''.join(parts)
+
+
+def iter_csv(users, fields=EXPORT_FIELDS, chunk_rows=CHUNK_ROWS):
+    """Yield the same text as ``csv.DictWriter`` with a header row"""
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    rows = 0
+    for u in users:
+        writer.writerow(u)
+        rows += 1
+        if rows >= chunk_rows:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+            rows = 0
+    yield output.getvalue()
+
+
+def parse_items(body, content_type):
+    """Parse a bulk request body: a JSON array, or NDJSON with one item per line"""
+    text = body.decode('utf-8')
+    if 'ndjson' in (content_type or ''):
+        items = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise ValueError(f'Line {number} is not valid JSON')
+        return items
+    try:
+        items = json.loads(text)
+    except ValueError:
+        raise ValueError('Request body must be a JSON array or NDJSON')
+    if not isinstance(items, list):
+        raise ValueError('Request body must be a JSON array or NDJSON')
+    return items
+
+
+def iter_import_rows(stream, format):
+    """Parse a CSV or NDJSON upload incrementally.
+
+    Yields ``(line number, item, error)`` per record, reading the binary
+    ``stream`` a buffer at a time so the whole body is never held in memory.
+    CSV uploads use the export columns; ``id`` is optional. A malformed
+    CSV row raises ValueError.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        missing = [f for f in EXPORT_FIELDS[1:] if f not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError('CSV is missing columns: %s' % ', '.join(missing))
+        try:
+            for row in reader:
+                item = {f: row[f] for f in EXPORT_FIELDS[1:]}
+                raw_id = (row.get('id') or '').strip()
+                if raw_id:
+                    if not raw_id.isdigit():
+                        yield reader.line_num, None, 'Id must be a positive integer'
+                        continue
+                    item['id'] = int(raw_id)
+                yield reader.line_num, item, None
+        except csv.Error as e:
+            # The reader cannot resync after a malformed row, so stop here
+            raise ValueError('CSV line %d: %s' % (reader.line_num, e))
+    else:
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                yield number, None, 'Line is not valid JSON'
+                continue
+            yield number, item, None
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip-compress an iterable of text chunks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+EXPORT_FORMATS = {
+    'json': (iter_json, 'application/json', 'users.json'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson', 'users.ndjson'),
+    'csv': (iter_csv, 'text/csv', 'users.csv'),
+}
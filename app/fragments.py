@@ -0,0 +1,112 @@
+"""Cached JSON fragments of individual user records.
+
+Encoding the same unchanged users on every listing and single-user
+response dominates serialization time. ``FragmentCache`` keeps the encoded
+JSON of recently used users and re-encodes a user only when the record
+differs from the one it was encoded from. Responses are assembled by
+joining fragments and are byte-identical to what ``jsonify`` would produce.
+"""
+import json
+from collections import OrderedDict
+
+from flask import current_app, has_app_context, jsonify
+
+from app import metrics
+
+
+class FragmentCache:
+    """Bounded LRU of encoded JSON per user id, for each encoder it is used with.
+
+    A fragment is reused for the record it was encoded from: the same
+    object, as the in-memory store hands out, or an equal one for backends
+    that build records per request. Writes from any worker or backend are
+    therefore picked up without explicit invalidation. A changed user's
+    fragment is replaced, a deleted user's is dropped by ``discard``, and
+    each encoder keeps at most ``max_entries`` fragments, evicting the least
+    recently used.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = {}
+
+    def __len__(self):
+        return sum(len(entries) for entries in list(self._entries.values()))
+
+    def encoder(self, encode):
+        """Return ``encode`` (a function of one user record) with its results cached"""
+        entries = self._entries.setdefault(encode, OrderedDict())
+        max_entries = self.max_entries
+
+        # OrderedDict operations are atomic, so only their combinations
+        # need care: an entry may be evicted between two of them
+        def cached(user):
+            user_id = user['id']
+            entry = entries.get(user_id)
+            if entry is not None and (entry[0] is user or entry[0] == user):
+                try:
+                    entries.move_to_end(user_id)
+                except KeyError:
+                    pass
+                return entry[1]
+            text = encode(user)
+            entries[user_id] = (user, text)
+            try:
+                while len(entries) > max_entries:
+                    entries.popitem(last=False)
+            except KeyError:
+                pass
+            return text
+        return cached
+
+    def discard(self, user_ids):
+        """Drop the fragments of users that no longer exist"""
+        for entries in list(self._entries.values()):
+            for user_id in user_ids:
+                entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries = {}
+
+
+def forget_users(user_ids):
+    """Drop cached fragments of deleted users from the current app's cache"""
+    if has_app_context():
+        fragments = current_app.extensions.get('json_fragments')
+        if fragments is not None:
+            fragments.discard(user_ids)
+
+
+def compact_sorted(user):
+    """A user as ``jsonify`` encodes it in compact mode"""
+    return json.dumps(user, separators=(',', ':'), sort_keys=True)
+
+
+def _reusable():
+    """Whether jsonify output is compact, sorted and ASCII, the form of ``compact_sorted``"""
+    app = current_app
+    provider = app.json
+    compact = provider.compact if provider.compact is not None else not app.debug
+    return (compact and provider.sort_keys and provider.ensure_ascii
+            and 'json_fragments' in app.extensions)
+
+
+def jsonify_user(user):
+    """``jsonify(user)``, from the cached fragment when possible"""
+    if not _reusable():
+        return jsonify(user)
+    encode = current_app.extensions['json_fragments'].encoder(compact_sorted)
+    return current_app.response_class(encode(user) + '\n', mimetype=current_app.json.mimetype)
+
+
+def jsonify_listing(listing):
+    """``jsonify(listing)`` for a dict with a ``data`` list of users, from cached fragments"""
+    rest = {key: value for key, value in listing.items() if key != 'data'}
+    # The body is built as 'data' followed by the other keys, sorted
+    if not _reusable() or any(key < 'data' for key in rest):
+        return jsonify(listing)
+    encode = current_app.extensions['json_fragments'].encoder(compact_sorted)
+    with metrics.span('serialize'):
+        tail = ',' + compact_sorted(rest)[1:] if rest else '}'
+        body = '{"data":[' + ','.join(map(encode, listing['data'])) + ']' + tail + '\n'
+    return current_app.response_class(body, mimetype=current_app.json.mimetype)
@@ -0,0 +1,287 @@
+"""In-process request and phase metrics, exposed in Prometheus text format.
+
+``span(name)`` times a phase of the current request (storage load, query,
+serialization, ...). Spans nest, so a phase includes the phases it calls.
+When metrics are disabled ``span`` hands back a shared no-op context
+manager and no request hooks are installed. The settings are kept per app
+in ``app.extensions['metrics']``, so apps in one process do not change
+each other's.
+
+Metrics live in the worker process: with several gunicorn workers each
+one reports its own counts.
+"""
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import Blueprint, Response, current_app, g, has_app_context, request
+from flask.json.provider import DefaultJSONProvider
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+_NOOP = nullcontext()
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, labels=()):
+        entry = self._values.get(labels)
+        return 0 if entry is None else entry[2]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, [list(e[0]), e[1], e[2]]) for labels, e in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+REQUESTS = Counter('app_http_requests_total', 'HTTP requests handled',
+                   ('method', 'endpoint', 'status'))
+REQUEST_SECONDS = Histogram('app_http_request_duration_seconds', 'HTTP request latency',
+                            ('method', 'endpoint'))
+PHASE_SECONDS = Histogram('app_phase_duration_seconds', 'Time spent in each phase of a request',
+                          ('endpoint', 'phase'))
+ERRORS = Counter('app_errors_total', 'Exceptions turned into error responses by the API',
+                 ('endpoint', 'exception'))
+CACHE_EVENTS = Counter('app_query_cache_events_total', 'Query cache hits, misses and evictions',
+                       ('event',))
+
+ADMISSIONS = Counter('app_admission_decisions_total',
+                     'Admission decisions: admitted, queued, rejected (queue full), timeout or expired',
+                     ('route_class', 'decision'))
+ADMISSION_QUEUE = Gauge('app_admission_queue_depth', 'Requests waiting for admission',
+                        ('route_class',))
+ADMISSION_IN_FLIGHT = Gauge('app_admission_in_flight', 'Admitted requests being handled',
+                            ('route_class',))
+ADMISSION_WAIT_SECONDS = Histogram('app_admission_wait_seconds', 'Time queued requests waited',
+                                   ('route_class',))
+
+REGISTRY = [REQUESTS, REQUEST_SECONDS, PHASE_SECONDS, ERRORS, CACHE_EVENTS,
+            ADMISSIONS, ADMISSION_QUEUE, ADMISSION_IN_FLIGHT, ADMISSION_WAIT_SECONDS]
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.reset()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_phase(self.name, time.perf_counter() - self.start)
+
+
+def enabled(app=None):
+    """Whether ``app`` (default: the current app) records metrics"""
+    if app is None:
+        if not has_app_context():
+            return False
+        app = current_app
+    settings = app.extensions.get('metrics')
+    return settings is not None and settings['enabled']
+
+
+def span(name):
+    """Context manager timing ``name`` as a phase of the current request"""
+    if not enabled():
+        return _NOOP
+    return _Span(name)
+
+
+def record_phase(name, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        endpoint = 'background'
+    else:
+        endpoint = _local.endpoint
+        phases[name] = phases.get(name, 0.0) + seconds
+    PHASE_SECONDS.observe((endpoint, name), seconds)
+
+
+def record_error(error):
+    """Count an exception that a view turned into an error response"""
+    if enabled():
+        ERRORS.inc((request.endpoint or 'unmatched', type(error).__name__))
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, with serialization timed as the ``serialize`` phase"""
+
+    def dumps(self, obj, **kwargs):
+        with span('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    _local.endpoint = request.endpoint or 'unmatched'
+    _local.phases = {}
+
+
+def _finish_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    phases = _local.phases
+    endpoint = _local.endpoint
+    _local.phases = None
+    method = request.method
+    path = request.path
+    slow_request_ms = current_app.extensions['metrics']['slow_request_ms']
+
+    def record():
+        elapsed = time.perf_counter() - start
+        REQUESTS.inc((method, endpoint, str(response.status_code)))
+        REQUEST_SECONDS.observe((method, endpoint), elapsed)
+        if slow_request_ms is not None and elapsed * 1000 >= slow_request_ms:
+            breakdown = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in
+                                 sorted(phases.items(), key=lambda item: -item[1]))
+            logger.warning('Slow request %s %s %d %.1fms %s', method, path,
+                           response.status_code, elapsed * 1000, breakdown or '(no phases)')
+
+    if response.is_streamed:
+        # Count the time spent streaming the body as well
+        response.call_on_close(record)
+    else:
+        record()
+    return response
+
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Install the request hooks and ``/metrics`` unless METRICS_ENABLED is false"""
+    app.extensions['metrics'] = {
+        'enabled': bool(app.config['METRICS_ENABLED']),
+        'slow_request_ms': app.config['METRICS_SLOW_REQUEST_MS'],
+    }
+    if not app.extensions['metrics']['enabled']:
+        return
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.register_blueprint(metrics_bp)
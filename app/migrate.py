@@ -0,0 +1,45 @@
+"""Copy users from the JSON file store into an SQLite database.
+
+Usage:
+    python -m app.migrate [--source data/users.json] [--target data/users.db] [--force]
+"""
+import argparse
+import os
+import sys
+
+from app.models import DATA_FILE
+from app.sqlite_store import SQLiteStore
+from app.storage import JsonFileStore
+
+
+def migrate(source, target, force=False):
+    """Copy every user (journal included) from ``source`` to ``target``; return the count"""
+    # A missing source would otherwise load as an empty store
+    if not os.path.isfile(source):
+        raise FileNotFoundError(f'{source} does not exist')
+    sqlite = SQLiteStore(target)
+    _, existing = sqlite.query(limit=0)
+    if existing and not force:
+        raise ValueError(f'{target} already holds {existing} users (use --force to replace them)')
+    users = JsonFileStore(source, search_index=False).all()
+    sqlite.replace_all(users)
+    return len(users)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default=str(DATA_FILE))
+    parser.add_argument('--target', default=str(DATA_FILE.with_suffix('.db')))
+    parser.add_argument('--force', action='store_true', help='replace users already in the target')
+    args = parser.parse_args(argv)
+    try:
+        count = migrate(args.source, args.target, args.force)
+    except (ValueError, FileNotFoundError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    print(f'Migrated {count} users from {args.source} to {args.target}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
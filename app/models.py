@@ -1,11 +1,26 @@
+import base64
+import hashlib
 import json
 import os
 from datetime import datetime
 from pathlib import Path
 
+from flask import current_app
+
+from app import metrics
+from app.fragments import forget_users
+from app.storage import (SORTABLE_FIELDS, ChangeLogGoneError, DuplicateEmailError, JsonFileStore,
+                         PreconditionFailedError)
+
 DATA_FILE = Path(__file__).parent.parent / 'data' / 'users.json'
+STORAGE_BACKENDS = ('json', 'sqlite')
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
 
 class User:
+    __slots__ = ('id', 'name', 'email', 'role')
+    
     def __init__(self, id, name, email, role):
         self.id = id
         self.name = name
@@ -37,11 +52,32 @@ class User:
         
         return errors
 
+def open_store(backend='json', path=None, compact_records=False):
+    """Create the storage backend named by ``USER_STORAGE``"""
+    if backend == 'json':
+        return JsonFileStore(path or DATA_FILE, compact_records=compact_records)
+    if backend == 'sqlite':
+        from app.sqlite_store import SQLiteStore
+        return SQLiteStore(path or DATA_FILE.with_suffix('.db'))
+    raise ValueError(f'Unknown storage backend {backend!r} (choose from {", ".join(STORAGE_BACKENDS)})')
+
 class UserDatabase:
+    @staticmethod
+    def init_app(app):
+        """Open the app's store as configured by USER_STORAGE, USER_DATA_PATH and USER_COMPACT_RECORDS"""
+        app.extensions['user_store'] = open_store(app.config['USER_STORAGE'], app.config['USER_DATA_PATH'],
+                                                  app.config['USER_COMPACT_RECORDS'])
+    
+    @staticmethod
+    def store():
+        """The store of the current app"""
+        return current_app.extensions['user_store']
+    
     @staticmethod
     def init_db():
-        DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
-        if not DATA_FILE.exists():
+        store = UserDatabase.store()
+        store.path.parent.mkdir(parents=True, exist_ok=True)
+        if not store.path.exists():
             UserDatabase.save_data([
                 User(1, "Alice Johnson", "alice@example.com", "Admin").to_dict(),
                 User(2, "Bob Smith", "bob@example.com", "User").to_dict(),
@@ -52,79 +88,216 @@ class UserDatabase:
     
     @staticmethod
     def load_data():
-        if DATA_FILE.exists():
-            with open(DATA_FILE, 'r') as f:
-                return json.load(f)
-        return []
+        return list(UserDatabase.store().all())
     
     @staticmethod
     def save_data(data):
-        DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        UserDatabase.store().replace_all(data)
     
     @staticmethod
-    def get_users(search='', page=1, limit=10, sort_by='id', order='asc'):
-        users = UserDatabase.load_data()
-        
-        # Filter by search
-        if search:
-            search_lower = search.lower()
-            users = [u for u in users if search_lower in u['name'].lower() or search_lower in u['email'].lower()]
-        
-        # Sort
-        reverse = order.lower() == 'desc'
-        if sort_by in ['id', 'name', 'email', 'role']:
-            users = sorted(users, key=lambda u: u[sort_by], reverse=reverse)
+    def get_users(search='', page=1, limit=10, sort_by='id', order='asc', cursor=None):
+        if cursor is not None:
+            return UserDatabase.get_users_after(cursor, search, limit, sort_by, order)
         
-        # Paginate
-        total = len(users)
         start = (page - 1) * limit
-        end = start + limit
+        with metrics.span('query'):
+            users, total = UserDatabase.store().query(search, sort_by, order, start, limit)
         
         return {
-            'data': users[start:end],
+            'data': users,
             'total': total,
             'page': page,
             'limit': limit,
             'pages': (total + limit - 1) // limit
         }
     
+    @staticmethod
+    def get_users_after(cursor, search='', limit=10, sort_by='id', order='asc'):
+        """Keyset pagination: return the page following ``cursor`` ('' for the first page)"""
+        if sort_by not in SORTABLE_FIELDS:
+            sort_by = 'id'
+        order = 'desc' if order.lower() == 'desc' else 'asc'
+        after = UserDatabase.decode_cursor(cursor, sort_by, order) if cursor else None
+        
+        # Fetch one extra row to learn whether there is a next page
+        with metrics.span('query'):
+            users, total = UserDatabase.store().query(search, sort_by, order, 0, limit + 1, after=after)
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = UserDatabase.encode_cursor(users[-1], sort_by, order)
+        
+        return {
+            'data': users,
+            'total': total,
+            'limit': limit,
+            'next_cursor': next_cursor
+        }
+    
+    @staticmethod
+    def encode_cursor(user, sort_by, order):
+        payload = json.dumps([sort_by, order, user[sort_by], user['id']], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+    
+    @staticmethod
+    def decode_cursor(cursor, sort_by, order):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            field, direction, value, user_id = json.loads(base64.urlsafe_b64decode(padded))
+        except (ValueError, TypeError):
+            raise InvalidCursorError('Invalid cursor')
+        if (field, direction) != (sort_by, order):
+            raise InvalidCursorError('Cursor does not match sort_by/order')
+        value_type = int if sort_by == 'id' else str
+        if type(value) is not value_type or type(user_id) is not int:
+            raise InvalidCursorError('Invalid cursor')
+        return (value, user_id)
+    
     @staticmethod
     def get_user_by_id(user_id):
-        users = UserDatabase.load_data()
-        for u in users:
-            if u['id'] == user_id:
-                return u
-        return None
+        return UserDatabase.store().get(user_id)
     
     @staticmethod
     def create_user(name, email, role):
-        users = UserDatabase.load_data()
-        new_id = max([u['id'] for u in users], default=0) + 1
-        new_user = {'id': new_id, 'name': name, 'email': email, 'role': role}
-        users.append(new_user)
-        UserDatabase.save_data(users)
-        return new_user
-    
-    @staticmethod
-    def update_user(user_id, name=None, email=None, role=None):
-        users = UserDatabase.load_data()
-        for u in users:
-            if u['id'] == user_id:
-                if name is not None:
-                    u['name'] = name
-                if email is not None:
-                    u['email'] = email
-                if role is not None:
-                    u['role'] = role
-                UserDatabase.save_data(users)
-                return u
-        return None
-    
-    @staticmethod
-    def delete_user(user_id):
-        users = UserDatabase.load_data()
-        users = [u for u in users if u['id'] != user_id]
-        UserDatabase.save_data(users)
-        return True
+        with metrics.span('write'):
+            return UserDatabase.store().create(name, email, role)
+    
+    @staticmethod
+    def update_user(user_id, name=None, email=None, role=None, if_match=None):
+        """Update a user; with ``if_match`` (a list of ETags) only if its current ETag is listed"""
+        with metrics.span('write'):
+            return UserDatabase.store().update(user_id, name=name, email=email, role=role,
+                                             precondition=UserDatabase._etag_precondition(if_match))
+    
+    @staticmethod
+    def get_user_by_email(email):
+        return UserDatabase.store().get_by_email(email)
+    
+    @staticmethod
+    def delete_user(user_id, if_match=None):
+        with metrics.span('write'):
+            deleted = UserDatabase.store().delete(user_id, precondition=UserDatabase._etag_precondition(if_match))
+        if deleted:
+            forget_users([user_id])
+        return deleted
+    
+    @staticmethod
+    def data_version():
+        """Sequence number of the last write; changes whenever any user changes"""
+        UserDatabase.store().refresh()
+        return UserDatabase.store().version
+    
+    @staticmethod
+    def data_tag():
+        """Validator for the data as a whole; unlike the data version it also
+        changes when users.json is replaced outside the app"""
+        UserDatabase.store().refresh()
+        return UserDatabase.store().data_tag()
+    
+    @staticmethod
+    def last_modified():
+        UserDatabase.store().refresh()
+        return UserDatabase.store().last_modified
+    
+    @staticmethod
+    def get_changes(since, limit=1000):
+        """
+        Writes after data version ``since``, oldest first. ``version`` is the
+        value to pass as ``since`` next time. Raises ChangeLogGoneError when
+        the client has to reload the full list instead.
+        """
+        changes, has_more = UserDatabase.store().changes(since, limit)
+        return {
+            'since': since,
+            'version': changes[-1]['seq'] if changes else since,
+            'changes': changes,
+            'has_more': has_more
+        }
+    
+    @staticmethod
+    def user_etag(user):
+        """Content hash of a user record, stable across workers and restarts"""
+        payload = json.dumps([user['id'], user['name'], user['email'], user['role']])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:20]
+    
+    @staticmethod
+    def _etag_precondition(if_match):
+        if if_match is None:
+            return None
+        return lambda user: UserDatabase.user_etag(user) in if_match
+    
+    @staticmethod
+    def bulk_create(items, atomic=False):
+        with metrics.span('write'):
+            return UserDatabase.store().apply_batch(
+                [('create', item) for item in items], User.validate, atomic)
+    
+    @staticmethod
+    def bulk_update(items, atomic=False):
+        with metrics.span('write'):
+            return UserDatabase.store().apply_batch(
+                [('update', item) for item in items], User.validate, atomic)
+    
+    @staticmethod
+    def bulk_delete(ids, atomic=False):
+        ops = [('delete', i.get('id') if isinstance(i, dict) else i) for i in ids]
+        with metrics.span('write'):
+            results = UserDatabase.store().apply_batch(ops, atomic=atomic)
+        forget_users([user['id'] for status, user in results if status < 400])
+        return results
+    
+    @staticmethod
+    def import_users(rows, chunk_size=1000, max_errors=100, on_chunk=None):
+        """
+        Upsert users from ``(line, item, error)`` rows, committing every
+        ``chunk_size`` rows. Rows with an id replace that user, rows without
+        one are created. At most ``max_errors`` errors are listed.
+        """
+        summary = {
+            'processed': 0,
+            'created': 0,
+            'updated': 0,
+            'failed': 0,
+            'chunks': 0,
+            'errors': []
+        }
+        chunk = []
+        
+        def fail(line, status, message):
+            summary['failed'] += 1
+            if len(summary['errors']) < max_errors:
+                summary['errors'].append({'line': line, 'status': status, 'error': message})
+        
+        def flush():
+            with metrics.span('write'):
+                results = UserDatabase.store().apply_batch([op for _, op in chunk], User.validate)
+            for (line, _), (status, value) in zip(chunk, results):
+                if status == 201:
+                    summary['created'] += 1
+                elif status == 200:
+                    summary['updated'] += 1
+                else:
+                    fail(line, status, value)
+            summary['chunks'] += 1
+            chunk.clear()
+            if on_chunk:
+                on_chunk(summary)
+        
+        try:
+            for line, item, error in rows:
+                summary['processed'] += 1
+                if error:
+                    fail(line, 400, error)
+                elif not isinstance(item, dict):
+                    fail(line, 400, 'Item must be a JSON object')
+                else:
+                    chunk.append((line, ('create' if item.get('id') is None else 'upsert', item)))
+                    if len(chunk) >= chunk_size:
+                        flush()
+        except ValueError as e:
+            # Unreadable input: stop, but keep what was committed so far
+            summary['error'] = str(e)
+        if chunk:
+            flush()
+        summary['errors_truncated'] = summary['failed'] > len(summary['errors'])
+        return summary
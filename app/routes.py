@@ -1,7 +1,10 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, make_response, render_template
 
 routes_bp = Blueprint('routes', __name__)
 
 @routes_bp.route('/')
 def index():
-    return render_template('dashboard.html')
+    response = make_response(render_template('dashboard.html'))
+    # The page links to fingerprinted assets, so it must not go stale
+    response.cache_control.no_cache = True
+    return response
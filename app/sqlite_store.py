@@ -0,0 +1,316 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from app import metrics
+from app.storage import (SORTABLE_FIELDS, ChangeLogGoneError, DuplicateEmailError,
+                         PreconditionFailedError, StorageBackend)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    role TEXT NOT NULL,
+    name_lc TEXT NOT NULL,
+    email_lc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_name ON users (name, id);
+CREATE INDEX IF NOT EXISTS users_email ON users (email, id);
+CREATE INDEX IF NOT EXISTS users_role ON users (role, id);
+CREATE INDEX IF NOT EXISTS users_email_lc ON users (email_lc);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT,
+    email TEXT,
+    role TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_seq ON changes (seq);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0), ('last_modified', 0.0);
+INSERT OR IGNORE INTO meta (key, value) SELECT 'changes_floor', value FROM meta WHERE key = 'version';
+"""
+
+COLUMNS = 'id, name, email, role'
+
+
+def _row(row):
+    return {'id': row[0], 'name': row[1], 'email': row[2], 'role': row[3]}
+
+
+def _values(user):
+    return (user['id'], user['name'], user['email'], user['role'],
+            user['name'].lower(), user['email'].lower())
+
+
+class SQLiteStore(StorageBackend):
+    """Users table in an SQLite database in WAL mode.
+
+    Readers never block writers and see a consistent snapshot; writes from
+    all worker processes are serialized by SQLite (``BEGIN IMMEDIATE``).
+    Search, sorting and pagination run in SQL against indexes on id, name,
+    email and role. Name and email are also stored lowercased with
+    ``str.lower`` so search matches exactly what the JSON store matches.
+    Each thread uses its own connection.
+
+    Every write transaction bumps the data version by one and records its
+    changes under that version in the ``changes`` table, which keeps the
+    last ``change_log_size`` rows.
+    """
+
+    def __init__(self, path, fsync=True, timeout=30.0, change_log_size=10000):
+        self.path = Path(path)
+        self.fsync = fsync
+        self.timeout = timeout
+        self.change_log_size = change_log_size
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=%s' % ('FULL' if self.fsync else 'NORMAL'))
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._schema_ready = True
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return conn
+
+    @contextmanager
+    def _read(self):
+        """A read transaction, so multi-statement reads see one snapshot"""
+        conn = self._connection()
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('COMMIT')
+
+    @contextmanager
+    def _write(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        with metrics.span('storage.commit'):
+            conn.execute('COMMIT')
+
+    def _touch(self, conn, changes):
+        """Bump the version and log ``changes`` (``('create' or 'put', user)`` or ``('delete', id)``) under it"""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'last_modified'", (time.time(),))
+        if changes is None:
+            # replace_all: nothing before this version can be replayed
+            conn.execute('DELETE FROM changes')
+            conn.execute("UPDATE meta SET value = (SELECT value FROM meta WHERE key = 'version') "
+                         "WHERE key = 'changes_floor'")
+            return
+        seq = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        conn.executemany('INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)', (
+            (seq, 'delete', c, None, None, None) if op == 'delete'
+            else (seq, op, c['id'], c['name'], c['email'], c['role'])
+            for op, c in changes))
+        # Prune whole versions only, so every version after the floor is complete
+        cutoff = conn.execute('SELECT seq FROM changes WHERE rowid <= (SELECT MAX(rowid) FROM changes) - ? '
+                              'ORDER BY rowid DESC LIMIT 1', (self.change_log_size,)).fetchone()
+        if cutoff is not None:
+            conn.execute('DELETE FROM changes WHERE seq <= ?', cutoff)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'changes_floor'", cutoff)
+
+    def _meta(self, key):
+        return self._connection().execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+
+    @property
+    def version(self):
+        return self._meta('version')
+
+    @property
+    def last_modified(self):
+        return self._meta('last_modified')
+
+    # -- reads ------------------------------------------------------------
+
+    def iter_all(self, batch_size=1000):
+        # A private connection: the caller may interleave other queries
+        # while a streaming export is still iterating
+        conn = self._open()
+        try:
+            conn.execute('BEGIN')
+            cursor = conn.execute(f'SELECT {COLUMNS} FROM users ORDER BY id')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _row(row)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _get(conn, user_id):
+        row = conn.execute(f'SELECT {COLUMNS} FROM users WHERE id = ?', (user_id,)).fetchone()
+        return None if row is None else _row(row)
+
+    @staticmethod
+    def _email_owner(conn, email_lc):
+        row = conn.execute('SELECT id FROM users WHERE email_lc = ? LIMIT 1', (email_lc,)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, user_id):
+        return self._get(self._connection(), user_id)
+
+    def get_by_email(self, email):
+        row = self._connection().execute(
+            f'SELECT {COLUMNS} FROM users WHERE email_lc = ? LIMIT 1', (email.lower(),)).fetchone()
+        return None if row is None else _row(row)
+
+    def query(self, search='', sort_by='id', order='asc', offset=0, limit=None,
+              after=None):
+        where, params = [], []
+        if search:
+            search_lower = search.lower()
+            where.append('(instr(name_lc, ?) > 0 OR instr(email_lc, ?) > 0)')
+            params += [search_lower, search_lower]
+        count_sql = 'SELECT COUNT(*) FROM users' + (' WHERE ' + ' AND '.join(where) if where else '')
+        count_params = list(params)
+
+        if sort_by in SORTABLE_FIELDS:
+            direction = 'DESC' if order.lower() == 'desc' else 'ASC'
+            order_by = f'{sort_by} {direction}' if sort_by == 'id' else f'{sort_by} {direction}, id {direction}'
+            if after is not None:
+                op = '<' if direction == 'DESC' else '>'
+                if sort_by == 'id':
+                    where.append(f'id {op} ?')
+                    params.append(after[1])
+                else:
+                    where.append(f'({sort_by}, id) {op} (?, ?)')
+                    params += [after[0], after[1]]
+        else:
+            order_by = 'id'
+        sql = (f'SELECT {COLUMNS} FROM users'
+               + (' WHERE ' + ' AND '.join(where) if where else '')
+               + f' ORDER BY {order_by} LIMIT ? OFFSET ?')
+        params += [-1 if limit is None else limit, offset]
+
+        with metrics.span('storage.sql'), self._read() as conn:
+            total = conn.execute(count_sql, count_params).fetchone()[0]
+            rows = [_row(r) for r in conn.execute(sql, params)]
+        return rows, total
+
+    def changes(self, since, limit=1000):
+        with self._read() as conn:
+            floor = conn.execute("SELECT value FROM meta WHERE key = 'changes_floor'").fetchone()[0]
+            version = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            if since < floor or since > version:
+                raise ChangeLogGoneError(f'Changes since version {since} are no longer available')
+            rows = conn.execute('SELECT seq, op, user_id, name, email, role FROM changes '
+                                'WHERE seq > ? ORDER BY rowid LIMIT ?', (since, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            if has_more:
+                # Never split the changes of one version across responses
+                last = rows[limit][0]
+                rows = [r for r in rows[:limit] if r[0] != last]
+                if not rows:
+                    rows = conn.execute('SELECT seq, op, user_id, name, email, role FROM changes '
+                                        'WHERE seq = ? ORDER BY rowid', (last,)).fetchall()
+        return [
+            {'seq': r[0], 'op': 'delete', 'id': r[2]} if r[1] == 'delete'
+            else {'seq': r[0], 'op': 'put', 'user': _row(r[2:]), 'created': True} if r[1] == 'create'
+            else {'seq': r[0], 'op': 'put', 'user': _row(r[2:])}
+            for r in rows
+        ], has_more
+
+    # -- writes -----------------------------------------------------------
+
+    def replace_all(self, users):
+        with self._write() as conn:
+            conn.execute('DELETE FROM users')
+            conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)',
+                             (_values(u) for u in users))
+            self._touch(conn, None)
+
+    def _check_email(self, conn, email, user_id=None):
+        owner = self._email_owner(conn, email.lower())
+        if owner is not None and owner != user_id:
+            raise DuplicateEmailError(f'Email {email} is already in use')
+
+    @staticmethod
+    def _next_id(conn):
+        return conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+
+    def create(self, name, email, role):
+        with self._write() as conn:
+            self._check_email(conn, email)
+            user = {'id': self._next_id(conn), 'name': name, 'email': email, 'role': role}
+            conn.execute('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)', _values(user))
+            self._touch(conn, [('create', user)])
+        return user
+
+    def update(self, user_id, name=None, email=None, role=None, precondition=None):
+        with self._write() as conn:
+            user = self._get(conn, user_id)
+            if user is None:
+                return None
+            if precondition is not None and not precondition(user):
+                raise PreconditionFailedError(f'User {user_id} has been modified')
+            if email is not None:
+                self._check_email(conn, email, user_id)
+            if name is not None:
+                user['name'] = name
+            if email is not None:
+                user['email'] = email
+            if role is not None:
+                user['role'] = role
+            conn.execute('UPDATE users SET name = ?, email = ?, role = ?, name_lc = ?, email_lc = ? '
+                         'WHERE id = ?', _values(user)[1:] + (user_id,))
+            self._touch(conn, [('put', user)])
+        return user
+
+    def delete(self, user_id, precondition=None):
+        with self._write() as conn:
+            user = self._get(conn, user_id)
+            if user is None:
+                return False
+            if precondition is not None and not precondition(user):
+                raise PreconditionFailedError(f'User {user_id} has been modified')
+            conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            self._touch(conn, [('delete', user_id)])
+        return True
+
+    def apply_batch(self, ops, validate=None, atomic=False):
+        with self._write() as conn:
+            results, records = self._plan_batch(
+                ops, validate, atomic,
+                lambda user_id: self._get(conn, user_id),
+                lambda email_lc: self._email_owner(conn, email_lc),
+                self._next_id(conn))
+            for record in records:
+                if record['op'] == 'put':
+                    conn.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)',
+                                 _values(record['user']))
+                else:
+                    conn.execute('DELETE FROM users WHERE id = ?', (record['id'],))
+            if records:
+                self._touch(conn, [('delete', r['id']) if r['op'] == 'delete'
+                                   else ('create' if r.get('created') else 'put', r['user'])
+                                   for r in records])
+        return results
@@ -6,10 +6,17 @@ let currentSort = 'id';
 let currentOrder = 'asc';
 let deleteTargetId = null;
 let editingUserId = null;
+let currentUsers = [];
+let currentTotal = 0;
+let dataVersion = null;
+let changePoll = null;
+let pollingChanges = false;
+let pollSoon = false;
+const CHANGES_POLL_MS = 5000;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
-    loadUsers();
+    loadUsers().then(watchChanges);
     setupEventListeners();
 });
 
@@ -46,8 +53,8 @@ function debounce(func, wait) {
 }
 
 // API calls
-async function loadUsers() {
-    showLoading(true);
+async function loadUsers(quiet = false) {
+    if (!quiet) showLoading(true);
     try {
         const params = new URLSearchParams({
             search: currentSearch,
@@ -66,19 +73,155 @@ async function loadUsers() {
         }
 
         const data = await response.json();
+        dataVersion = Number(response.headers.get('X-Data-Version'));
         renderUsers(data);
         renderPagination(data);
     } catch (error) {
         showError('Network error: ' + error.message);
         showEmptyState();
     } finally {
-        showLoading(false);
+        if (!quiet) showLoading(false);
+    }
+}
+
+// Live updates: poll the change feed and apply changes instead of
+// re-fetching the whole page after every write. Each poll is a short
+// request, so open dashboards do not tie up server threads.
+const reloadQuietly = debounce(() => loadUsers(true), 250);
+
+function watchChanges() {
+    if (changePoll !== null || dataVersion === null) return;
+    scheduleChanges(CHANGES_POLL_MS);
+}
+
+function scheduleChanges(delay) {
+    clearTimeout(changePoll);
+    changePoll = setTimeout(pollChanges, delay);
+}
+
+async function pollChanges() {
+    if (pollingChanges) {
+        pollSoon = true;
+        return;
+    }
+    pollingChanges = true;
+    pollSoon = false;
+    let delay = CHANGES_POLL_MS;
+    try {
+        if (!document.hidden) {
+            const response = await fetch(`/api/users/changes?since=${dataVersion}`);
+            if (response.status === 410) {
+                // Too far behind the change log: start over from a fresh listing
+                await loadUsers(true);
+            } else if (response.ok) {
+                const data = await response.json();
+                data.changes.forEach(applyChange);
+                dataVersion = Math.max(dataVersion, data.version);
+                if (data.has_more) delay = 0;
+            } else {
+                const retryAfter = Number(response.headers.get('Retry-After'));
+                delay = Math.max(delay, retryAfter * 1000 || 0);
+            }
+        }
+    } catch (error) {
+        // Offline or restarting: try again on the next poll
+    } finally {
+        pollingChanges = false;
+        scheduleChanges(pollSoon ? 0 : delay);
+    }
+}
+
+function applyChange(change) {
+    if (change.seq <= dataVersion) return;
+    dataVersion = change.seq;
+    const id = change.op === 'put' ? change.user.id : change.id;
+    const index = currentUsers.findIndex(user => user.id === id);
+    if (index !== -1) {
+        if (change.op === 'put' && matchesSearch(change.user) &&
+                change.user[currentSort] === currentUsers[index][currentSort]) {
+            // Same row, same place on the page: update it in place
+            currentUsers[index] = change.user;
+            const row = document.getElementById('usersTableBody').rows[index];
+            row.replaceWith(renderUserRow(change.user));
+            return;
+        }
+        // The row leaves the page or moves on it
+        reloadQuietly();
+        return;
+    }
+    // Off the page: only rows entering the page, or added or removed
+    // before it, change what is shown
+    if (change.op === 'put') {
+        if (!matchesSearch(change.user)) return;
+        const position = pagePosition(change.user);
+        if (position === 0) {
+            reloadQuietly();
+        } else if (change.created) {
+            if (position < 0) {
+                reloadQuietly();
+            } else {
+                adjustTotal(1);
+            }
+        }
+        // An update sorting outside the page keeps the page as it is
+    } else if (currentPage === 1 && !currentSearch) {
+        // Nothing sorts before the first page, and every user was counted
+        adjustTotal(-1);
+    } else {
+        reloadQuietly();
+    }
+}
+
+function compareUsers(a, b) {
+    // The server's order: the sort column, then id
+    const keyA = [a[currentSort], a.id];
+    const keyB = [b[currentSort], b.id];
+    for (let i = 0; i < 2; i++) {
+        if (keyA[i] < keyB[i]) return currentOrder === 'desc' ? 1 : -1;
+        if (keyA[i] > keyB[i]) return currentOrder === 'desc' ? -1 : 1;
+    }
+    return 0;
+}
+
+function pagePosition(user) {
+    // -1 if the user sorts before this page, 1 after it, 0 if it would be shown
+    if (currentUsers.length === 0) return 0;
+    if (currentPage > 1 && compareUsers(user, currentUsers[0]) < 0) return -1;
+    if (currentUsers.length === pageSize &&
+            compareUsers(user, currentUsers[currentUsers.length - 1]) > 0) return 1;
+    return 0;
+}
+
+function adjustTotal(delta) {
+    currentTotal = Math.max(currentTotal + delta, 0);
+    renderPagination({
+        page: currentPage,
+        pages: Math.ceil(currentTotal / pageSize),
+        total: currentTotal,
+        limit: pageSize
+    });
+}
+
+function matchesSearch(user) {
+    const search = currentSearch.toLowerCase();
+    return !search || user.name.toLowerCase().includes(search) ||
+        user.email.toLowerCase().includes(search);
+}
+
+function refreshAfterWrite() {
+    // While polling, our own writes arrive like anyone else's; ask right away
+    if (changePoll === null) {
+        loadUsers();
+    } else {
+        scheduleChanges(0);
     }
 }
 
 function renderUsers(data) {
     const tbody = document.getElementById('usersTableBody');
     tbody.innerHTML = '';
+    currentUsers = data.data || [];
+    currentTotal = data.total || 0;
 
     if (!data.data || data.data.length === 0) {
         showEmptyState();
@@ -88,38 +231,40 @@ function renderUsers(data) {
     document.getElementById('emptyState').classList.add('hidden');
     document.getElementById('tableContainer').classList.remove('hidden');
 
-    data.data.forEach(user => {
-        const row = document.createElement('tr');
-        row.className = 'table-row border-b border-gray-200';
-        
-        const roleBadgeClass = `badge-${user.role.toLowerCase()} text-white`;
-        
-        row.innerHTML = `
-            <td class="px-6 py-4 font-semibold text-gray-800">#${user.id}</td>
-            <td class="px-6 py-4">
-                <div class="font-semibold text-gray-800">${escapeHtml(user.name)}</div>
-            </td>
-            <td class="px-6 py-4 text-gray-600">${escapeHtml(user.email)}</td>
-            <td class="px-6 py-4">
-                <span class="${roleBadgeClass} px-3 py-1 rounded-full text-sm font-medium">
-                    ${user.role}
-                </span>
-            </td>
-            <td class="px-6 py-4">
-                <div class="flex justify-center gap-2">
-                    <button onclick="openEditUserModal(${user.id})" 
-                        class="px-3 py-2 rounded-lg bg-blue-100 text-blue-700 hover:bg-blue-200 font-medium text-sm transition-all">
-                        <i class="fas fa-edit"></i>
-                    </button>
-                    <button onclick="openDeleteModal(${user.id})" 
-                        class="px-3 py-2 rounded-lg bg-red-100 text-red-700 hover:bg-red-200 font-medium text-sm transition-all">
-                        <i class="fas fa-trash"></i>
-                    </button>
-                </div>
-            </td>
-        `;
-        tbody.appendChild(row);
-    });
+    data.data.forEach(user => tbody.appendChild(renderUserRow(user)));
+}
+
+function renderUserRow(user) {
+    const row = document.createElement('tr');
+    row.className = 'table-row border-b border-gray-200';
+    
+    const roleBadgeClass = `badge-${user.role.toLowerCase()} text-white`;
+    
+    row.innerHTML = `
+        <td class="px-6 py-4 font-semibold text-gray-800">#${user.id}</td>
+        <td class="px-6 py-4">
+            <div class="font-semibold text-gray-800">${escapeHtml(user.name)}</div>
+        </td>
+        <td class="px-6 py-4 text-gray-600">${escapeHtml(user.email)}</td>
+        <td class="px-6 py-4">
+            <span class="${roleBadgeClass} px-3 py-1 rounded-full text-sm font-medium">
+                ${user.role}
+            </span>
+        </td>
+        <td class="px-6 py-4">
+            <div class="flex justify-center gap-2">
+                <button onclick="openEditUserModal(${user.id})" 
+                    class="px-3 py-2 rounded-lg bg-blue-100 text-blue-700 hover:bg-blue-200 font-medium text-sm transition-all">
+                    <i class="fas fa-edit"></i>
+                </button>
+                <button onclick="openDeleteModal(${user.id})" 
+                    class="px-3 py-2 rounded-lg bg-red-100 text-red-700 hover:bg-red-200 font-medium text-sm transition-all">
+                    <i class="fas fa-trash"></i>
+                </button>
+            </div>
+        </td>
+    `;
+    return row;
 }
 
 function renderPagination(data) {
@@ -263,8 +408,8 @@ async function saveUser(event) {
 
         showSuccess(userId ? 'User updated successfully' : 'User created successfully');
         closeUserModal();
-        currentPage = 1;
-        loadUsers();
+        if (!userId) currentPage = 1;
+        refreshAfterWrite();
     } catch (error) {
         showError('Network error: ' + error.message);
     }
@@ -296,8 +441,7 @@ async function confirmDelete() {
 
         showSuccess('User deleted successfully');
         closeDeleteModal();
-        currentPage = 1;
-        loadUsers();
+        refreshAfterWrite();
     } catch (error) {
         showError('Network error: ' + error.message);
     }
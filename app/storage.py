@@ -0,0 +1,1078 @@
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import operator
+import os
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from app import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, shared by all worker processes.
+
+    The lock file is opened on every acquisition so that processes forked
+    after it was created do not share the lock. Without ``fcntl`` (Windows)
+    the lock only covers threads of the current process.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+SORTABLE_FIELDS = ('id', 'name', 'email', 'role')
+
+
+class DuplicateEmailError(ValueError):
+    """Raised when a write would give two users the same email address"""
+
+
+class PreconditionFailedError(Exception):
+    """Raised when a conditional write finds the record in another state"""
+
+
+class ChangeLogGoneError(Exception):
+    """Raised when the change log no longer reaches back to the requested version"""
+
+
+def _email_key(email):
+    """Lowercased email for the email index, sharing the string when unchanged"""
+    key = email.lower()
+    return email if key == email else key
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _bisect_left(ids, key, keyfunc):
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keyfunc(ids[mid]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class UserRecord:
+    """Compact in-memory user, used by ``JsonFileStore(compact_records=True)``.
+
+    With role strings interned so each distinct role is stored once, a
+    store of slotted records retains about 62-65% of the memory of the
+    dict layout (``benchmarks/bench_memory.py``). ``record[field]`` works
+    as for dicts so the indexes handle both layouts; callers only ever see
+    the ``to_dict()`` form.
+    """
+    __slots__ = ('id', 'name', 'email', 'role')
+
+    # record['name'] is record.name, without a Python-level call
+    __getitem__ = object.__getattribute__
+
+    def __init__(self, id, name, email, role):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.role = sys.intern(role) if type(role) is str else role
+
+    @classmethod
+    def from_dict(cls, user):
+        return cls(user['id'], user['name'], user['email'], user['role'])
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'email': self.email, 'role': self.role}
+
+
+class _PendingWrite:
+    __slots__ = ('mutate', 'result', 'error', 'done')
+
+    def __init__(self, mutate):
+        self.mutate = mutate
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class StorageBackend:
+    """Interface shared by the user storage backends.
+
+    Records are plain dicts with ``id``, ``name``, ``email`` and ``role``.
+    Returned records must not be mutated by callers.
+    """
+
+    version = 0
+    last_modified = 0.0
+
+    def refresh(self):
+        """Pick up changes made by other processes"""
+
+    def data_tag(self):
+        """A string that changes whenever the data does and is the same in every process"""
+        return str(self.version)
+
+    def all(self):
+        """Return every record as a list"""
+        return list(self.iter_all())
+
+    def iter_all(self):
+        """Iterate over every record from one consistent snapshot"""
+        raise NotImplementedError
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def get_by_email(self, email):
+        raise NotImplementedError
+
+    def query(self, search='', sort_by='id', order='asc', offset=0, limit=None,
+              after=None):
+        """Return ``(records, total)`` for one page of a filtered, sorted listing.
+
+        Records are ordered by ``(sort_by, id)``; ``desc`` reverses that
+        order. ``after`` is the ``(value, id)`` key of the last record of the
+        previous page and makes the page start right after it (keyset
+        pagination), ``offset`` then counts from there. ``total`` is the
+        number of matches regardless of ``after``. An unknown ``sort_by``
+        keeps insertion order and ignores ``after``.
+        """
+        raise NotImplementedError
+
+    def changes(self, since, limit=1000):
+        """Return ``(changes, has_more)`` for the writes after version ``since``.
+
+        Changes are ``{'seq', 'op': 'put', 'user'}`` (with ``'created':
+        True`` when the write created the user) or ``{'seq', 'op':
+        'delete', 'id'}`` in commit order; ``seq`` is the data version the
+        write produced. Raises ChangeLogGoneError when ``since`` is older
+        than the retained log, newer than the data, or precedes a
+        ``replace_all``; the caller must then reload everything.
+        """
+        raise NotImplementedError
+
+    def replace_all(self, users):
+        raise NotImplementedError
+
+    def create(self, name, email, role):
+        raise NotImplementedError
+
+    def update(self, user_id, name=None, email=None, role=None, precondition=None):
+        """Update a user; ``precondition(current)`` must hold or PreconditionFailedError is raised"""
+        raise NotImplementedError
+
+    def delete(self, user_id, precondition=None):
+        raise NotImplementedError
+
+    def apply_batch(self, ops, validate=None, atomic=False):
+        """Apply many writes with a single durable commit.
+
+        ``ops`` is a list of ``('create', fields)``, ``('update', fields
+        with id)``, ``('upsert', full record)`` or ``('delete', id)``; an
+        upsert that leaves a record unchanged writes nothing. ``validate``
+        is called with each resulting record and returns a list of error
+        messages. Returns one ``(status, value)`` per op, where value is the
+        resulting (or deleted) record or an error message. With ``atomic``
+        nothing is applied if any op fails, and the ops that would have
+        succeeded report 424.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _plan_batch(ops, validate, atomic, lookup, email_owner, next_id):
+        """Work out the results and ``put``/``delete`` records of a batch.
+
+        ``lookup(id)`` and ``email_owner(lowercased email)`` read the
+        committed state; changes made by earlier ops of the batch are
+        layered on top. Returns ``(results, records)``; records is empty when
+        an atomic batch is rejected.
+        """
+        pending = {}
+        emails = {}
+        results = []
+        records = []
+
+        def current(user_id):
+            return pending[user_id] if user_id in pending else lookup(user_id)
+
+        def owner(email):
+            email = email.lower()
+            return emails[email] if email in emails else email_owner(email)
+
+        def claim(user, old=None):
+            if old is not None:
+                emails[old['email'].lower()] = None
+            emails[user['email'].lower()] = user['id']
+            pending[user['id']] = user
+
+        for kind, item in ops:
+            if kind == 'delete':
+                user_id = item
+                if type(user_id) is not int:
+                    results.append((400, 'Id must be an integer'))
+                    continue
+                old = current(user_id)
+                if old is None:
+                    results.append((404, f'User {user_id} not found'))
+                    continue
+                emails[old['email'].lower()] = None
+                pending[user_id] = None
+                records.append({'op': 'delete', 'id': user_id})
+                results.append((200, old))
+                continue
+
+            if not isinstance(item, dict):
+                results.append((400, 'Item must be a JSON object'))
+                continue
+            if kind == 'create':
+                old = None
+                user = {'id': next_id, 'name': item.get('name'),
+                        'email': item.get('email'), 'role': item.get('role')}
+            elif kind == 'upsert':
+                user_id = item.get('id')
+                if type(user_id) is not int or user_id < 1:
+                    results.append((400, 'Id must be a positive integer'))
+                    continue
+                old = current(user_id)
+                user = {'id': user_id, 'name': item.get('name'),
+                        'email': item.get('email'), 'role': item.get('role')}
+                if user == old:
+                    results.append((200, old))
+                    continue
+            else:
+                user_id = item.get('id')
+                if type(user_id) is not int:
+                    results.append((400, 'Id must be an integer'))
+                    continue
+                old = current(user_id)
+                if old is None:
+                    results.append((404, f'User {user_id} not found'))
+                    continue
+                user = dict(old)
+                user.update((k, item[k]) for k in ('name', 'email', 'role') if k in item)
+            errors = validate(user) if validate else []
+            if errors:
+                results.append((400, '; '.join(errors)))
+                continue
+            taken_by = owner(user['email'])
+            if taken_by is not None and taken_by != user['id']:
+                results.append((409, f"Email {user['email']} is already in use"))
+                continue
+            if kind == 'create':
+                next_id += 1
+            elif user['id'] >= next_id:
+                next_id = user['id'] + 1
+            claim(user, old)
+            records.append({'op': 'put', 'user': user, 'created': True} if old is None
+                           else {'op': 'put', 'user': user})
+            results.append((201 if old is None else 200, user))
+
+        if atomic and any(status >= 400 for status, _ in results):
+            return [(424, 'Not applied because another item failed')
+                    if status < 400 else (status, value)
+                    for status, value in results], []
+        return results, records
+
+
+class JsonFileStore(StorageBackend):
+    """Process-resident copy of the JSON users data.
+
+    The snapshot file is parsed once and kept in memory. Every access checks
+    the files' inode, mtime and size and only re-reads what changed, e.g.
+    because another process wrote to them.
+
+    In journal mode (the default) each mutation is appended as one JSON line
+    to ``<snapshot>.journal`` and fsynced, so write cost does not depend on
+    the number of users. On load the journal is replayed on top of the
+    snapshot. Once the journal grows past ``compact_ops`` records or
+    ``compact_bytes`` bytes it is folded into a new snapshot by a background
+    thread. Snapshots are always written to a temp file and renamed into
+    place. Journal records are idempotent (``put``/``delete``/``reset``), so
+    replaying a journal over a newer snapshot after a crash mid-compaction
+    yields the same state.
+
+    With ``journal=False`` every mutation rewrites the snapshot instead.
+
+    The last ``change_log_size`` put/delete records applied (by this or
+    any other process) are kept for ``changes()``.
+
+    With ``compact_records`` the records are held as ``UserRecord`` objects
+    instead of dicts and converted to dicts only when handed out, which
+    cuts the memory per user by about a third. Keys other than id, name, email and
+    role are dropped on load in that mode.
+
+    Records are indexed by id (a dict), by lowercased email (a unique
+    index) and, once a column has been sorted on, by a list of ids kept in
+    ``(value, id)`` order that is updated incrementally on every write.
+    With ``search_index`` enabled, a trigram inverted index over the
+    lowercased name and email narrows search candidates before the exact
+    substring check.
+
+    Writes are safe across worker processes: they run under an exclusive
+    lock on ``<snapshot>.lock`` and first catch up with whatever other
+    workers appended, so ids stay unique and no update is lost. Writers
+    that arrive while another commit is in flight (or within
+    ``group_commit_window`` seconds of the leader) are committed together
+    with a single write and fsync.
+    """
+
+    def __init__(self, path, journal=True, compact_ops=1000,
+                 compact_bytes=4 * 1024 * 1024, fsync=True,
+                 group_commit_window=0.0, search_index=True, compact_records=False,
+                 change_log_size=10000):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + '.journal')
+        self.file_lock = FileLock(self.path.with_name(self.path.name + '.lock'))
+        self.journal = journal
+        self.compact_ops = compact_ops
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self.group_commit_window = group_commit_window
+        self.search_index = search_index
+        self.compact_records = compact_records
+        self.version = 0
+        self.last_modified = 0.0
+        self._lock = threading.RLock()
+        self._commit_lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._queue = []
+        self._staged = []
+        self._users = {}
+        self._emails = {}
+        self._orders = {}
+        self._grams = {}
+        self._list = []
+        self._changes = collections.deque(maxlen=change_log_size)
+        self._max_id = 0
+        self._snapshot_stamp = None
+        self._journal_stamp = None
+        self._journal_offset = 0
+        self._journal_ops = 0
+        self._compacting = False
+        self._loaded = False
+
+    # -- change detection -------------------------------------------------
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _journal_stat(self):
+        st = self._stat(self.journal_path)
+        return None if st is None else (st[0], st[2])
+
+    def _is_current(self):
+        return (self._loaded
+                and self._stat(self.path) == self._snapshot_stamp
+                and self._journal_stat() == self._journal_stamp)
+
+    def refresh(self):
+        """Bring the in-memory records up to date with the files on disk"""
+        if self._is_current():
+            return
+        with self._lock:
+            if self._is_current():
+                return
+            journal = self._journal_stat()
+            if (self._stat(self.path) == self._snapshot_stamp
+                    and journal is not None
+                    and self._journal_stamp is not None
+                    and journal[0] == self._journal_stamp[0]
+                    and journal[1] >= self._journal_offset):
+                self._replay_journal()
+            elif not self._adopt_compaction(journal):
+                self._load()
+
+    def _adopt_compaction(self, journal):
+        """Keep the in-memory records when another process only compacted.
+
+        A compaction replaces both files and starts the new journal with a
+        ``base`` record carrying the snapshot's sequence number. If we have
+        already applied that sequence number, the new snapshot holds nothing
+        we do not know, so we only replay newer journal records.
+        """
+        if (not self._loaded or journal is None
+                or self._journal_stamp is None
+                or journal[0] == self._journal_stamp[0]):
+            return False
+        snapshot = self._stat(self.path)
+        try:
+            with open(self.journal_path, 'rb') as f:
+                header = json.loads(f.readline() or b'null')
+        except (FileNotFoundError, ValueError):
+            return False
+        if (not isinstance(header, dict) or header.get('op') != 'base'
+                or header['seq'] > self.version):
+            return False
+        self._snapshot_stamp = snapshot
+        self._journal_offset = 0
+        self._journal_ops = 0
+        self._replay_journal(skip_applied=True)
+        return True
+
+    def _load(self):
+        with metrics.span('storage.load'):
+            try:
+                f = open(self.path, 'r')
+            except FileNotFoundError:
+                stamp, users = None, []
+                self.last_modified = 0.0
+            else:
+                with f:
+                    st = os.fstat(f.fileno())
+                    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+                    users = json.load(f, object_hook=UserRecord.from_dict if self.compact_records else None)
+                self.last_modified = st.st_mtime
+        with metrics.span('storage.index'):
+            self._users = {u['id']: u for u in users}
+            self._emails = {_email_key(u['email']): u['id'] for u in users}
+            self._orders = {}
+            self._grams = {}
+            if self.search_index:
+                index_grams = self._index_grams
+                for u in users:
+                    index_grams(u)
+        self._changes.clear()
+        self._max_id = None
+        self._snapshot_stamp = stamp
+        self._journal_stamp = None
+        self._journal_offset = 0
+        self._journal_ops = 0
+        if self.journal:
+            self.version = 0
+        else:
+            self.version += 1
+        self._replay_journal()
+        self._list = None
+        self._loaded = True
+
+    def _replay_journal(self, skip_applied=False):
+        with metrics.span('storage.replay'):
+            try:
+                f = open(self.journal_path, 'rb')
+            except FileNotFoundError:
+                self._journal_stamp = None
+                self._journal_offset = 0
+                return
+            with f:
+                ino = os.fstat(f.fileno()).st_ino
+                f.seek(self._journal_offset)
+                data = f.read()
+            # A torn last line (crash mid-append) is ignored until rewritten
+            end = data.rfind(b'\n') + 1
+            applied = self.version
+            for line in data[:end].splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    if skip_applied and record.get('seq', 0) <= applied:
+                        if record['op'] != 'base':
+                            self._journal_ops += 1
+                        continue
+                    self._apply(record)
+            self._journal_offset += end
+            self._journal_stamp = (ino, self._journal_offset + len(data) - end)
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'put':
+            user = record['user']
+            if self.compact_records:
+                user = UserRecord.from_dict(user)
+            old = self._users.get(user['id'])
+            if old is not None:
+                self._unindex(old)
+            self._users[user['id']] = user
+            self._index(user)
+            if self._max_id is not None and user['id'] > self._max_id:
+                self._max_id = user['id']
+        elif op == 'delete':
+            old = self._users.get(record['id'])
+            if old is not None:
+                self._unindex(old)
+                del self._users[record['id']]
+            if record['id'] == self._max_id:
+                self._max_id = None
+        elif op == 'reset':
+            self._users = {}
+            self._emails = {}
+            self._orders = {}
+            self._grams = {}
+            self._max_id = 0
+        if op in ('put', 'delete'):
+            if 'seq' in record:
+                self._changes.append(record)
+        else:
+            # The history before a snapshot or reset is not in the log
+            self._changes.clear()
+        if op != 'base':
+            self._journal_ops += 1
+        self.version = record.get('seq', self.version)
+        self.last_modified = record.get('ts', self.last_modified)
+        self._list = None
+
+    # -- indexes ----------------------------------------------------------
+
+    def _sort_key(self, field):
+        users = self._users
+        if field == 'id':
+            return None
+        get = operator.attrgetter(field) if self.compact_records else operator.itemgetter(field)
+        return lambda user_id: (get(users[user_id]), user_id)
+
+    @staticmethod
+    def _user_grams(user):
+        return _trigrams(user['name'].lower()) | _trigrams(user['email'].lower())
+
+    def _index_grams(self, user):
+        grams = self._grams
+        user_id = user['id']
+        for gram in self._user_grams(user):
+            ids = grams.get(gram)
+            if ids is None:
+                grams[gram] = {user_id}
+            else:
+                ids.add(user_id)
+
+    def _index(self, user):
+        self._emails[_email_key(user['email'])] = user['id']
+        if self.search_index:
+            self._index_grams(user)
+        for field, ids in self._orders.items():
+            keyfunc = self._sort_key(field)
+            if keyfunc is None:
+                pos = bisect.bisect_left(ids, user['id'])
+            else:
+                pos = _bisect_left(ids, keyfunc(user['id']), keyfunc)
+            ids.insert(pos, user['id'])
+
+    def _unindex(self, user):
+        """Drop a record from the indexes; it must still be in ``_users``"""
+        email = user['email'].lower()
+        if self._emails.get(email) == user['id']:
+            del self._emails[email]
+        if self.search_index:
+            for gram in self._user_grams(user):
+                ids = self._grams.get(gram)
+                if ids is not None:
+                    ids.discard(user['id'])
+                    if not ids:
+                        del self._grams[gram]
+        for field, ids in self._orders.items():
+            keyfunc = self._sort_key(field)
+            if keyfunc is None:
+                pos = bisect.bisect_left(ids, user['id'])
+            else:
+                pos = _bisect_left(ids, keyfunc(user['id']), keyfunc)
+            del ids[pos]
+
+    def _order(self, field):
+        """Return all ids sorted by ``(field, id)``, building the index on first use"""
+        ids = self._orders.get(field)
+        if ids is None:
+            with self._lock:
+                ids = self._orders.get(field)
+                if ids is None:
+                    with metrics.span('storage.sort_index'):
+                        ids = sorted(self._users, key=self._sort_key(field))
+                    self._orders[field] = ids
+        return ids
+
+    def _search_candidates(self, search_lower):
+        """Return ids that may match ``search_lower``, or None to scan everything.
+
+        Queries shorter than a trigram, or whose rarest trigram still occurs
+        in more than a quarter of all users, are cheaper to scan.
+        """
+        if not self.search_index or len(search_lower) < 3:
+            return None
+        with self._lock:
+            postings = []
+            for gram in _trigrams(search_lower):
+                ids = self._grams.get(gram)
+                if not ids:
+                    return set()
+                postings.append(ids)
+            postings.sort(key=len)
+            if len(postings[0]) * 4 > len(self._users):
+                return None
+            return postings[0].intersection(*postings[1:])
+
+    def _search(self, search):
+        """Return the records whose lowercased name or email contains ``search``"""
+        search_lower = search.lower()
+        self.refresh()
+        with metrics.span('storage.search'):
+            candidates = self._search_candidates(search_lower)
+            if candidates is None:
+                return [u for u in self._records()
+                        if search_lower in u['name'].lower() or search_lower in u['email'].lower()]
+            users = self._users
+            rows = []
+            for user_id in candidates:
+                u = users.get(user_id)
+                if u is not None and (search_lower in u['name'].lower()
+                                      or search_lower in u['email'].lower()):
+                    rows.append(u)
+            return rows
+
+    def _check_email(self, email, user_id=None):
+        owner = self._emails.get(email.lower())
+        if owner is not None and owner != user_id:
+            raise DuplicateEmailError(f'Email {email} is already in use')
+
+    # -- durable writes ---------------------------------------------------
+
+    def _stage(self, records):
+        """Assign sequence numbers to mutation records and apply them in memory"""
+        staged = []
+        now = time.time()
+        for record in records:
+            record = {'seq': self.version + 1, 'ts': now, **record}
+            self._apply(record)
+            staged.append(record)
+        self._staged.extend(staged)
+
+    def _submit(self, mutate):
+        """Run ``mutate`` as part of a group commit and return its result.
+
+        ``mutate`` runs under the store and file locks against up-to-date
+        records and calls ``_stage`` for the changes it makes. The first
+        queued writer becomes the leader and commits everything queued so
+        far with one durable write; the others find their write done.
+        """
+        write = _PendingWrite(mutate)
+        with self._queue_lock:
+            self._queue.append(write)
+        with self._commit_lock:
+            if not write.done:
+                if self.group_commit_window:
+                    time.sleep(self.group_commit_window)
+                with self._queue_lock:
+                    batch, self._queue = self._queue, []
+                self._commit_batch(batch)
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _commit_batch(self, batch):
+        try:
+            with self.file_lock:
+                sync = self._write_batch(batch)
+                # Readers only need _lock, which is already released: they
+                # see the batch while it is made durable, but writers (in
+                # this and other processes) wait for it
+                if sync is not None:
+                    try:
+                        with metrics.span('storage.commit'):
+                            sync()
+                    except BaseException:
+                        # Memory is ahead of disk; force a full reload next time
+                        self._loaded = False
+                        raise
+        except Exception as e:
+            for write in batch:
+                write.error = write.error or e
+        finally:
+            for write in batch:
+                write.done = True
+        if self.journal and self._needs_compaction():
+            self._compact_in_background()
+
+    def _write_batch(self, batch):
+        """Apply the batch in memory and hand its records to the OS.
+
+        Returns a function that makes them durable, to be called after
+        ``_lock`` is released, or None when nothing changed.
+        """
+        with self._lock:
+            self.refresh()
+            self._staged = []
+            for write in batch:
+                try:
+                    write.result = write.mutate()
+                except Exception as e:
+                    write.error = e
+            staged, self._staged = self._staged, []
+            if not staged:
+                return None
+            try:
+                if self.journal:
+                    return self._append_journal(staged)
+                return self._write_snapshot()
+            except BaseException:
+                self._loaded = False
+                raise
+
+    def _append_journal(self, records):
+        """Write ``records`` to the journal; return a function that fsyncs them"""
+        data = b''.join(
+            json.dumps(r).encode('utf-8') + b'\n' for r in records
+        )
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.journal_path, 'ab')
+        try:
+            if (self._journal_stamp is not None
+                    and self._journal_stamp[1] != self._journal_offset):
+                f.truncate(self._journal_offset)
+            f.write(data)
+            f.flush()
+            ino = os.fstat(f.fileno()).st_ino
+        except BaseException:
+            f.close()
+            raise
+        self._journal_offset += len(data)
+        self._journal_stamp = (ino, self._journal_offset)
+
+        def sync():
+            with f:
+                if self.fsync:
+                    os.fsync(f.fileno())
+        return sync
+
+    def _write_temp(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name('.%s.%d.%d.tmp' % (
+            path.name, os.getpid(), threading.get_ident()))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        return tmp
+
+    def _replace(self, tmp, path):
+        os.replace(tmp, path)
+        self._sync_dir(path)
+
+    def _sync_dir(self, path):
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _encode_snapshot(users):
+        return json.dumps(users, indent=2, default=UserRecord.to_dict).encode('utf-8')
+
+    def _write_snapshot(self):
+        """Encode the records; return a function that writes them durably"""
+        data = self._encode_snapshot(list(self._users.values()))
+
+        def sync():
+            tmp = self._write_temp(self.path, data)
+            with self._lock:
+                os.replace(tmp, self.path)
+                self._snapshot_stamp = self._stat(self.path)
+            self._sync_dir(self.path)
+        return sync
+
+    # -- compaction -------------------------------------------------------
+
+    def _needs_compaction(self):
+        return ((self.compact_ops is not None
+                 and self._journal_ops >= self.compact_ops)
+                or (self.compact_bytes is not None
+                    and self._journal_offset >= self.compact_bytes))
+
+    def _compact_in_background(self):
+        if self._compacting:
+            return
+        self._compacting = True
+        # Decided here: the compaction thread runs outside the app context
+        span = metrics.span('storage.compact')
+
+        def run():
+            try:
+                with span:
+                    self.compact()
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=run, name='users-compaction', daemon=True).start()
+
+    def _file_identity(self):
+        journal = self._journal_stamp
+        return (self._snapshot_stamp, journal and journal[0])
+
+    def data_tag(self):
+        # The sequence number starts over when users.json is replaced by
+        # something other than a compaction, so the tag names the snapshot
+        # too. Without a journal every write replaces the snapshot.
+        with self._lock:
+            stamp, version = self._snapshot_stamp, self.version
+        snapshot = f'{zlib.crc32(repr(stamp).encode()):08x}'
+        return f'{snapshot}-{version}' if self.journal else snapshot
+
+    def compact(self):
+        """Fold the journal into a new snapshot.
+
+        The snapshot is serialized outside the lock; only the final renames
+        block writers. Records appended meanwhile are carried over into the
+        new journal. Returns True if a new snapshot was written.
+        """
+        # Writers hold the file lock but not _lock while they fsync; the
+        # commit lock keeps compaction out until they are done
+        with self._commit_lock, self._lock, self.file_lock:
+            self.refresh()
+            if not self.journal or self._journal_ops == 0:
+                return False
+            users = self._records()
+            seq = self.version
+            last_modified = self.last_modified
+            offset = self._journal_offset
+            stamps = self._file_identity()
+        tmp_snapshot = self._write_temp(self.path, self._encode_snapshot(users))
+        try:
+            with self._commit_lock, self._lock, self.file_lock:
+                self.refresh()
+                if self._file_identity() != stamps:
+                    return False
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read(self._journal_offset - offset)
+                header = json.dumps({'seq': seq, 'ts': last_modified, 'op': 'base'}).encode('utf-8') + b'\n'
+                tmp_journal = self._write_temp(self.journal_path, header + tail)
+                self._replace(tmp_snapshot, self.path)
+                tmp_snapshot = None
+                self._replace(tmp_journal, self.journal_path)
+                self._snapshot_stamp = self._stat(self.path)
+                self._journal_offset = len(header) + len(tail)
+                self._journal_stamp = (self._journal_stat()[0], self._journal_offset)
+                self._journal_ops = tail.count(b'\n')
+                return True
+        finally:
+            if tmp_snapshot is not None and os.path.exists(tmp_snapshot):
+                os.unlink(tmp_snapshot)
+
+    # -- public API -------------------------------------------------------
+
+    def _records(self):
+        """Return the current list of stored records (must not be mutated)"""
+        self.refresh()
+        users = self._list
+        if users is None:
+            with self._lock:
+                users = self._list
+                if users is None:
+                    users = self._list = list(self._users.values())
+        return users
+
+    def _as_dict(self, user):
+        if self.compact_records and user is not None:
+            return user.to_dict()
+        return user
+
+    def _as_dicts(self, users):
+        if self.compact_records:
+            return [u.to_dict() for u in users]
+        return users
+
+    def all(self):
+        """Return the current list of records (must not be mutated)"""
+        return self._as_dicts(self._records())
+
+    def iter_all(self):
+        users = self._records()
+        if self.compact_records:
+            return (u.to_dict() for u in users)
+        return iter(users)
+
+    def get(self, user_id):
+        self.refresh()
+        return self._as_dict(self._users.get(user_id))
+
+    def get_by_email(self, email):
+        self.refresh()
+        user_id = self._emails.get(email.lower())
+        return None if user_id is None else self._as_dict(self._users.get(user_id))
+
+    def query(self, search='', sort_by='id', order='asc', offset=0, limit=None,
+              after=None):
+        reverse = order.lower() == 'desc'
+        end = None if limit is None else offset + limit
+        if after is not None:
+            after = tuple(after)
+        if search:
+            rows = self._search(search)
+            total = len(rows)
+            if sort_by not in SORTABLE_FIELDS:
+                matched = {u['id'] for u in rows}
+                rows = [u for u in self._records() if u['id'] in matched]
+                return self._as_dicts(rows[offset:end]), total
+            with metrics.span('storage.sort'):
+                rows = self._top(rows, sort_by, reverse, after, offset, limit)
+            return self._as_dicts(rows), total
+        if sort_by not in SORTABLE_FIELDS:
+            rows = self._records()
+            return self._as_dicts(rows[offset:end]), len(rows)
+
+        self.refresh()
+        with self._lock:
+            users = self._users
+            ids = self._order(sort_by)
+            total = len(ids)
+            lo, hi = 0, total
+            if after is not None:
+                keyfunc = self._sort_key(sort_by)
+                if keyfunc is None:
+                    pos = bisect.bisect_left(ids, after[1])
+                    found = pos < total and ids[pos] == after[1]
+                else:
+                    pos = _bisect_left(ids, after, keyfunc)
+                    found = pos < total and keyfunc(ids[pos]) == after
+                if reverse:
+                    hi = pos
+                else:
+                    lo = pos + 1 if found else pos
+            if reverse:
+                stop = max(hi - offset, 0)
+                start = 0 if limit is None else max(stop - limit, 0)
+                page = ids[start:stop][::-1]
+            else:
+                start = lo + offset
+                page = ids[start:None if limit is None else start + limit]
+            return self._as_dicts([users[i] for i in page]), total
+
+    @staticmethod
+    def _top(rows, sort_by, reverse, after, offset, limit):
+        """Sort just enough of ``rows`` to return the requested page.
+
+        Shallow pages are picked with a bounded heap instead of sorting every
+        match.
+        """
+        def key(u):
+            return (u[sort_by], u['id'])
+
+        if after is not None:
+            if reverse:
+                rows = [u for u in rows if key(u) < after]
+            else:
+                rows = [u for u in rows if key(u) > after]
+        if limit is None:
+            rows.sort(key=key, reverse=reverse)
+            return rows[offset:]
+        k = offset + limit
+        if k * 10 < len(rows):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            return select(k, rows, key=key)[offset:]
+        rows.sort(key=key, reverse=reverse)
+        return rows[offset:k]
+
+    def replace_all(self, users):
+        def mutate():
+            records = [{'op': 'reset'}]
+            records.extend({'op': 'put', 'user': dict(u)} for u in users)
+            self._stage(records)
+
+        self._submit(mutate)
+        if self.journal:
+            self.compact()
+
+    def apply_batch(self, ops, validate=None, atomic=False):
+        def mutate():
+            results, records = self._plan_batch(
+                ops, validate, atomic, lambda user_id: self._as_dict(self._users.get(user_id)),
+                self._emails.get, self._next_id())
+            self._stage(records)
+            return results
+
+        return self._submit(mutate)
+
+    def changes(self, since, limit=1000):
+        self.refresh()
+        with self._lock:
+            log = self._changes
+            floor = log[0]['seq'] - 1 if log else self.version
+            if since < floor or since > self.version:
+                raise ChangeLogGoneError(f'Changes since version {since} are no longer available')
+            # Sequence numbers are consecutive, so the log can be indexed
+            start = since - floor
+            records = list(itertools.islice(log, start, start + limit + 1))
+        has_more = len(records) > limit
+        changes = []
+        for r in records[:limit]:
+            if r['op'] == 'put':
+                change = {'seq': r['seq'], 'op': 'put', 'user': r['user']}
+                if r.get('created'):
+                    change['created'] = True
+                changes.append(change)
+            else:
+                changes.append({'seq': r['seq'], 'op': 'delete', 'id': r['id']})
+        return changes, has_more
+
+    def _next_id(self):
+        if self._max_id is None:
+            self._max_id = max(self._users, default=0)
+        return self._max_id + 1
+
+    def create(self, name, email, role):
+        def mutate():
+            self._check_email(email)
+            new_user = {'id': self._next_id(), 'name': name, 'email': email, 'role': role}
+            self._stage([{'op': 'put', 'user': new_user, 'created': True}])
+            return new_user
+
+        return self._submit(mutate)
+
+    def update(self, user_id, name=None, email=None, role=None, precondition=None):
+        def mutate():
+            u = self._as_dict(self._users.get(user_id))
+            if u is None:
+                return None
+            if precondition is not None and not precondition(u):
+                raise PreconditionFailedError(f'User {user_id} has been modified')
+            if email is not None:
+                self._check_email(email, user_id)
+            u = dict(u)
+            if name is not None:
+                u['name'] = name
+            if email is not None:
+                u['email'] = email
+            if role is not None:
+                u['role'] = role
+            self._stage([{'op': 'put', 'user': u}])
+            return u
+
+        return self._submit(mutate)
+
+    def delete(self, user_id, precondition=None):
+        def mutate():
+            u = self._as_dict(self._users.get(user_id))
+            if u is None:
+                return False
+            if precondition is not None and not precondition(u):
+                raise PreconditionFailedError(f'User {user_id} has been modified')
+            self._stage([{'op': 'delete', 'id': user_id}])
+            return True
+
+        return self._submit(mutate)
@@ -0,0 +1,5 @@
+"""Performance benchmarks for the user management app.
+
+Run the regression suite with ``python -m benchmarks``; the standalone
+``bench_*.py`` scripts compare individual implementation choices.
+"""
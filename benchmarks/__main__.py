@@ -0,0 +1,230 @@
+"""Run the benchmark suite and compare it against a stored baseline.
+
+Usage:
+    python -m benchmarks [--sizes 10k 100k 1m] [--iterations 200] [--repeat 3]
+                         [--storage json|sqlite] [--output report.json]
+                         [--baseline benchmarks/baseline.json] [--save-baseline] [--threshold 0.25]
+
+The JSON report goes to stdout (or ``--output``), a readable summary to
+stderr. With a baseline the exit status is 1 when any scenario regressed.
+Each size is run ``--repeat`` times. A compared run keeps the best value of
+each metric, while ``--save-baseline`` keeps the worst, so scheduler and
+disk noise (write tails) on either side does not flag a clean tree.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+from app import create_app
+from benchmarks.data import parse_size, write_users
+from benchmarks.scenarios import api_scenarios, db_scenarios
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def percentile(quantiles, samples, p):
+    return quantiles[p - 1] if quantiles else samples[0]
+
+
+def measure(scenario, iterations):
+    """Time ``iterations`` runs of a scenario, then trace one more for memory"""
+    if scenario.warmup:
+        scenario.op(iterations + 1)
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        scenario.op(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    scenario.op(iterations)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else []
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(quantiles, samples, 50), 4),
+        'p95_ms': round(percentile(quantiles, samples, 95), 4),
+        'p99_ms': round(percentile(quantiles, samples, 99), 4),
+        'mean_ms': round(statistics.fmean(samples), 4),
+        'ops_per_sec': round(iterations / elapsed, 1),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def run_size(size, args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.json')
+        write_users(path, size, args.seed)
+        if args.storage == 'sqlite':
+            from app.migrate import migrate
+            migrate(path, os.path.join(tmpdir, 'users.db'))
+            path = os.path.join(tmpdir, 'users.db')
+        app = create_app({
+            'TESTING': True,
+            'USER_STORAGE': args.storage,
+            'USER_DATA_PATH': path,
+            'USER_COMPACT_RECORDS': args.compact_records,
+            # Time the listing path itself; cache hits have their own scenario
+            'QUERY_CACHE_SIZE': 0,
+        })
+        client = app.test_client()
+        results = {}
+        for scenario in api_scenarios(client, size) + db_scenarios(size):
+            if args.only and not any(name in scenario.name for name in args.only):
+                continue
+            with app.app_context():
+                results[scenario.name] = measure(scenario, scenario.iterations or args.iterations)
+            print_row(scenario.name, results[scenario.name])
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def merge_runs(runs, worst=False):
+    """Merge repeated runs of a size, keeping each metric's best (or worst) value"""
+    pick_cost, pick_rate = (max, min) if worst else (min, max)
+    merged = {}
+    for name, stats in runs[0].items():
+        samples = [run[name] for run in runs if name in run]
+        merged[name] = {
+            metric: (pick_rate if metric == 'ops_per_sec' else pick_cost)(s[metric] for s in samples)
+            for metric in stats
+        }
+    return merged
+
+
+def print_row(name, stats, baseline=None, flagged=()):
+    row = (f'{name:<18}{stats["p50_ms"]:>10.3f}{stats["p95_ms"]:>10.3f}{stats["p99_ms"]:>10.3f}'
+           f'{stats["ops_per_sec"]:>11,.1f}{stats["peak_kb"]:>11,.0f}')
+    if baseline is not None:
+        row += f'{baseline["p95_ms"]:>12.3f}  ' + ', '.join(flagged)
+    print(row, file=sys.stderr)
+
+
+def print_header(title, baseline=False):
+    print(f'\n{title}', file=sys.stderr)
+    print(f'{"scenario":<18}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"ops/s":>11}{"peak KB":>11}'
+          + (f'{"base p95":>12}' if baseline else ''), file=sys.stderr)
+
+
+def compare(report, baseline, threshold, memory_threshold, min_delta_ms):
+    """Return ``[(size, scenario, [regressed metrics])]`` for scenarios slower than the baseline.
+
+    A latency metric regresses when it is more than ``threshold`` (a
+    fraction) and ``min_delta_ms`` above the baseline; peak memory when it
+    is more than ``memory_threshold`` above it. Scenarios missing from the
+    baseline are skipped.
+    """
+    regressions = []
+    for size, results in report['runs'].items():
+        base_results = baseline.get('runs', {}).get(size, {})
+        for name, stats in results.items():
+            base = base_results.get(name)
+            if base is None:
+                continue
+            flagged = [
+                metric for metric in ('p50_ms', 'p95_ms')
+                if stats[metric] > base[metric] * (1 + threshold)
+                and stats[metric] - base[metric] > min_delta_ms
+            ]
+            if stats['peak_kb'] > base['peak_kb'] * (1 + memory_threshold) and stats['peak_kb'] - base['peak_kb'] > 64:
+                flagged.append('peak_kb')
+            if flagged:
+                regressions.append((size, name, flagged))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[10000, 100000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size (best kept, worst for a baseline)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--compact-records', action='store_true')
+    parser.add_argument('--only', nargs='+', help='run scenarios whose name contains any of these')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help=f'compare against this report (default {BASELINE} if it exists)')
+    parser.add_argument('--save-baseline', action='store_true', help='store this report as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p50/p95 slowdown (fraction)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25, help='allowed peak memory growth (fraction)')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='ignore latency changes below this')
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'storage': args.storage,
+            'compact_records': args.compact_records,
+            'iterations': args.iterations,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'runs': {},
+    }
+    for size in args.sizes:
+        runs = []
+        for attempt in range(1, args.repeat + 1):
+            print_header(f'{size:,} users ({args.storage}), run {attempt}/{args.repeat}')
+            runs.append(run_size(size, args))
+        report['runs'][str(size)] = merge_runs(runs, worst=args.save_baseline)
+    if resource is not None:
+        report['meta']['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.baseline or BASELINE, 'w') as f:
+            f.write(output + '\n')
+        return 0
+
+    baseline_path = args.baseline or (BASELINE if os.path.exists(BASELINE) else None)
+    if baseline_path is None:
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    for key in ('storage', 'compact_records', 'platform'):
+        if baseline['meta'].get(key) != report['meta'][key]:
+            print(f'warning: baseline {key} is {baseline["meta"].get(key)!r}, '
+                  f'this run {report["meta"][key]!r}', file=sys.stderr)
+    regressions = compare(report, baseline, args.threshold, args.memory_threshold, args.min_delta_ms)
+    flagged = {(size, name): metrics for size, name, metrics in regressions}
+    for size, results in report['runs'].items():
+        base_results = baseline.get('runs', {}).get(size, {})
+        print_header(f'{int(size):,} users vs {baseline_path}', baseline=True)
+        for name, stats in results.items():
+            if name in base_results:
+                print_row(name, stats, base_results[name], flagged.get((size, name), ()))
+    if regressions:
+        print(f'\n{len(regressions)} scenario(s) regressed beyond the thresholds', file=sys.stderr)
+        return 1
+    print('\nNo regressions', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
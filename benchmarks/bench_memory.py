@@ -0,0 +1,65 @@
+"""Compare the memory held by the JSON store for dict and compact records.
+
+Usage:
+    python benchmarks/bench_memory.py [--sizes 1000000] [--search-index]
+"""
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.storage import JsonFileStore
+from benchmarks.data import write_users
+
+
+def measure(path, compact_records, search_index):
+    """Return ``(retained bytes, peak bytes, load seconds)`` of a loaded store"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = JsonFileStore(path, compact_records=compact_records, search_index=search_index)
+    store.refresh()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return current, peak, elapsed
+
+
+def run(size, search_index):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.json')
+        write_users(path, size)
+        print(f'\n{size:,} users (search index {"on" if search_index else "off"})')
+        print(f'{"layout":<10}{"bytes/user":>12}{"retained MB":>14}{"peak MB":>10}{"load s":>9}')
+        results = {}
+        for layout, compact in (('dict', False), ('compact', True)):
+            current, peak, elapsed = measure(path, compact, search_index)
+            results[layout] = current
+            print(f'{layout:<10}{current / size:>12,.0f}{current / 2**20:>14,.1f}'
+                  f'{peak / 2**20:>10,.1f}{elapsed:>9.2f}')
+        print(f'compact records use {results["compact"] / results["dict"]:.0%} of the dict layout')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--search-index', action='store_true',
+                        help='include the trigram search index in the measurement')
+    args = parser.parse_args(argv)
+    for size in args.sizes:
+        run(size, args.search_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Compare name/email search latency: trigram index vs. full scan.
+
+Usage:
+    python benchmarks/bench_search.py [--sizes 100000 1000000] [--repeat 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.storage import JsonFileStore
+from benchmarks.data import timed, write_users
+
+# From very selective to matching every user
+QUERIES = ['olga clark7', 'smith', 'ali', 'example.com', 'al']
+
+
+def scan(users, search):
+    """The search as implemented before the trigram index"""
+    search_lower = search.lower()
+    return [u for u in users if search_lower in u['name'].lower() or search_lower in u['email'].lower()]
+
+
+def run(size, repeat):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.json')
+        write_users(path, size)
+        start = time.perf_counter()
+        store = JsonFileStore(path)
+        users = store.all()
+        load_ms = (time.perf_counter() - start) * 1000
+        print(f'\n{size:,} users (load + index build {load_ms:,.0f} ms)')
+        print(f'{"query":<16}{"matches":>10}{"scan ms":>12}{"index ms":>12}{"speedup":>10}')
+        for query in QUERIES:
+            expected = scan(users, query)
+            got = store._search(query)
+            assert sorted(u['id'] for u in got) == [u['id'] for u in expected]
+            scan_ms = timed(lambda: scan(users, query), repeat)
+            index_ms = timed(lambda: store._search(query), repeat)
+            print(f'{query:<16}{len(expected):>10,}{scan_ms:>12.2f}{index_ms:>12.2f}'
+                  f'{scan_ms / index_ms:>9.1f}x')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+    for size in args.sizes:
+        run(size, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
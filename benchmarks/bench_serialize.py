@@ -0,0 +1,52 @@
+"""Compare listing serialization cost per 1k users: re-encoding vs. cached JSON fragments.
+
+Usage:
+    python benchmarks/bench_serialize.py [--limits 10 1000] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import jsonify
+
+from app import create_app
+from app.fragments import FragmentCache, jsonify_listing
+from benchmarks.data import make_users, timed
+
+
+def run(app, limit, repeat):
+    users = make_users(limit)
+    fragments = app.extensions['json_fragments'] = FragmentCache(limit)
+    listing = {'data': users, 'total': 100000, 'page': 1, 'limit': limit,
+               'pages': (100000 + limit - 1) // limit}
+    encode = lambda: jsonify(listing).get_data()
+    cached = lambda: jsonify_listing(listing).get_data()
+    fragments.clear()
+    start = time.perf_counter()
+    cached()
+    cold_ms = (time.perf_counter() - start) * 1000
+    encode_ms = timed(encode, repeat)
+    cached_ms = timed(cached, repeat)
+    assert encode() == cached()
+    scale = 1000 / limit
+    print(f'{limit:<10}{encode_ms * scale:>14.3f}{cold_ms * scale:>12.3f}{cached_ms * scale:>14.3f}'
+          f'{encode_ms / cached_ms:>9.1f}x')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--limits', type=int, nargs='+', default=[10, 1000], help='rows per listing')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+    app = create_app({'METRICS_ENABLED': False})
+    print(f'{"rows":<10}{"encode ms/1k":>14}{"cold ms/1k":>12}{"cached ms/1k":>14}{"speedup":>10}')
+    with app.test_request_context():
+        for limit in args.limits:
+            run(app, limit, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Deterministic synthetic users for benchmarks"""
+import json
+import random
+import statistics
+import time
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'David', 'Eva', 'Frank', 'Grace', 'Hector',
+               'Ivy', 'Jack', 'Karen', 'Liam', 'Maya', 'Noah', 'Olga', 'Paul']
+LAST_NAMES = ['Johnson', 'Smith', 'Davis', 'Wilson', 'Martinez', 'Brown', 'Garcia',
+              'Miller', 'Lopez', 'Taylor', 'Anderson', 'Thomas', 'Moore', 'Clark']
+ROLES = ['Admin', 'Manager', 'User']
+
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+
+
+def parse_size(value):
+    """Accept ``10k``/``100k``/``1m`` as well as a plain row count"""
+    return SIZES.get(value.lower()) or int(value)
+
+
+def make_users(count, seed=42):
+    """Return ``count`` users; the same seed always yields the same users"""
+    rng = random.Random(seed)
+    users = []
+    for i in range(1, count + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        users.append({
+            'id': i,
+            'name': f'{first} {last}{i % 100}',
+            'email': f'{first.lower()}.{last.lower()}{i}@example.com',
+            'role': rng.choice(ROLES),
+        })
+    return users
+
+
+def write_users(path, count, seed=42):
+    with open(path, 'w') as f:
+        json.dump(make_users(count, seed), f)
+
+
+def timed(fn, repeat):
+    """Median wall time of ``repeat`` calls of ``fn``, in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
@@ -0,0 +1,175 @@
+"""Overload test: latency of admitted requests at multiples of saturation.
+
+Starts the app in a threaded server in a child process and measures its
+saturation throughput for a search listing with a closed loop. It then
+offers open-loop load at multiples of that rate without admission
+control, and with it both with and without an ``X-Request-Start`` stamp
+on each request (as a proxy would set it). For each run it reports the
+share of requests answered 200 versus shed with 429/503, and the p50/p99
+latency of the admitted ones.
+
+Usage:
+    python benchmarks/load_test.py [--users 100000] [--duration 5] [--loads 1 2 3]
+                                   [--limit 4] [--queue 8] [--timeout 0.25]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from benchmarks.data import write_users
+
+URL = '/api/users?search=smith&sort_by=name&limit=50'
+
+
+def serve(port, path, admission, limit, queue, timeout):
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    from app import create_app
+    app = create_app({
+        'USER_DATA_PATH': path,
+        'QUERY_CACHE_SIZE': 0,
+        'ADMISSION_ENABLED': admission,
+        'ADMISSION_POLICIES': {'read': {'limit': limit, 'queue': queue, 'timeout': timeout}},
+    })
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(path, admission, args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, __file__, '--serve', str(port), path, str(int(admission)),
+        str(args.limit), str(args.queue), str(args.timeout)])
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            if request(port, '/api/users?limit=1')[0] == 200:
+                return process, port
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+def request(port, url=URL, stamp=False):
+    """Return ``(status, seconds)`` for one GET; status is None if the connection failed"""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        # Stamped like a proxy would, so time spent in the listen backlog
+        # counts against the deadline
+        headers = {'X-Request-Start': f't={time.time():.6f}'} if stamp else {}
+        conn.request('GET', url, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    except OSError:
+        return None, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def saturation(port, seconds, concurrency=8):
+    """Throughput of a closed loop that keeps ``concurrency`` requests in flight"""
+    done = []
+    stop = time.monotonic() + seconds
+
+    def loop():
+        while time.monotonic() < stop:
+            done.append(request(port))
+
+    threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(done) / (time.monotonic() - start)
+
+
+def offer(port, rate, seconds, stamp):
+    """Send ``rate`` requests per second for ``seconds``; return the results"""
+    results = []
+    with ThreadPoolExecutor(max_workers=512) as pool:
+        start = time.monotonic()
+        for i in range(int(rate * seconds)):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            results.append(pool.submit(request, port, URL, stamp))
+    return [f.result() for f in results]
+
+
+def summarize(results):
+    admitted = sorted(seconds * 1000 for status, seconds in results if status == 200)
+    shed = sum(1 for status, _ in results if status in (429, 503))
+    failed = sum(1 for status, _ in results if status is None)
+    quantiles = statistics.quantiles(admitted, n=100) if len(admitted) > 1 else admitted * 99
+    return {
+        'ok': len(admitted) / len(results),
+        'shed': shed / len(results),
+        'failed': failed / len(results),
+        'p50': quantiles[49] if admitted else float('nan'),
+        'p99': quantiles[98] if admitted else float('nan'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per load level')
+    parser.add_argument('--loads', type=float, nargs='+', default=[1.0, 2.0, 3.0],
+                        help='offered load as multiples of saturation throughput')
+    parser.add_argument('--limit', type=int, default=4, help='concurrent reads admitted')
+    parser.add_argument('--queue', type=int, default=8, help='reads allowed to wait')
+    parser.add_argument('--timeout', type=float, default=0.25, help='seconds a read may wait')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'users.json')
+        write_users(path, args.users)
+        for admission, stamp in ((False, False), (True, False), (True, True)):
+            process, port = start_server(path, admission, args)
+            try:
+                capacity = saturation(port, args.duration)
+                label = ('on, X-Request-Start' if stamp else 'on, no stamp') if admission else 'off'
+                print(f'\nadmission {label} '
+                      f'(saturation {capacity:.0f} req/s, {args.users:,} users)')
+                print(f'{"load":>6}{"offered/s":>11}{"200":>8}{"shed":>8}{"failed":>8}'
+                      f'{"p50 ms":>10}{"p99 ms":>10}')
+                for load in args.loads:
+                    row = summarize(offer(port, capacity * load, args.duration, stamp))
+                    print(f'{load:>5.1f}x{capacity * load:>11.0f}{row["ok"]:>8.0%}{row["shed"]:>8.0%}'
+                          f'{row["failed"]:>8.0%}{row["p50"]:>10.1f}{row["p99"]:>10.1f}')
+            finally:
+                process.kill()
+                process.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        port, path, admission, limit, queue, timeout = sys.argv[2:8]
+        serve(int(port), path, admission == '1', int(limit), int(queue), float(timeout))
+    else:
+        main()
@@ -0,0 +1,124 @@
+"""Benchmark scenarios, each a named operation run many times.
+
+Every scenario exists twice: through the Flask test client (``api.*``,
+including routing and JSON encoding) and directly against ``UserDatabase``
+(``db.*``). Operations receive the iteration number, so runs are
+reproducible, and raise ``AssertionError`` when a response is wrong, so a
+fast but broken implementation cannot pass as an improvement.
+
+The API scenarios repeat the same requests, so they run with the query
+cache off; ``api.list_cached`` times listing cache hits on their own.
+"""
+from app.cache import QueryCache
+from app.formats import iter_csv, iter_json
+from app.models import UserDatabase
+
+PAGE_LIMIT = 20
+SEARCH = 'smith'
+EXPORT_ITERATIONS = 5
+
+
+class Scenario:
+    def __init__(self, name, op, iterations=None, warmup=True):
+        self.name = name
+        self.op = op
+        self.iterations = iterations
+        self.warmup = warmup
+
+
+def _expect(response, status):
+    assert response.status_code == status, (
+        f'{response.request.method} {response.request.path} returned '
+        f'{response.status_code}, expected {status}')
+    return response.get_data()
+
+
+def api_scenarios(client, size):
+    deep_page = max(size // PAGE_LIMIT - 1, 1)
+    created = []
+
+    def get(url):
+        return lambda i: _expect(client.get(url), 200)
+
+    def cached(url):
+        cache = QueryCache()
+
+        def op(i):
+            extensions = client.application.extensions
+            extensions['query_cache'] = cache
+            try:
+                _expect(client.get(url), 200)
+            finally:
+                del extensions['query_cache']
+            assert len(cache) == 1, 'listing was not cached'
+        return op
+
+    def get_by_id(i):
+        _expect(client.get(f'/api/users/{i * 7919 % size + 1}'), 200)
+
+    def create(i):
+        response = client.post('/api/users', json={
+            'name': f'Api Bench {i}', 'email': f'api.bench{i}@example.org', 'role': 'User'})
+        _expect(response, 201)
+        created.append(response.get_json()['id'])
+
+    def update(i):
+        _expect(client.put(f'/api/users/{i * 7919 % size + 1}', json={'role': 'Manager'}), 200)
+
+    def delete(i):
+        _expect(client.delete(f'/api/users/{created.pop()}'), 200)
+
+    return [
+        Scenario('api.list', get(f'/api/users?page=1&limit={PAGE_LIMIT}')),
+        Scenario('api.search', get(f'/api/users?search={SEARCH}&limit={PAGE_LIMIT}')),
+        Scenario('api.sort', get(f'/api/users?sort_by=name&order=desc&limit={PAGE_LIMIT}')),
+        Scenario('api.deep_page', get(f'/api/users?sort_by=name&page={deep_page}&limit={PAGE_LIMIT}')),
+        Scenario('api.list_cached', cached(f'/api/users?page=1&limit={PAGE_LIMIT}')),
+        Scenario('api.get_by_id', get_by_id),
+        Scenario('api.create', create, warmup=False),
+        Scenario('api.update', update, warmup=False),
+        Scenario('api.delete', delete, warmup=False),
+        Scenario('api.export_csv', get('/api/users/export?format=csv'), EXPORT_ITERATIONS),
+        Scenario('api.export_json', get('/api/users/export?format=json'), EXPORT_ITERATIONS),
+    ]
+
+
+def db_scenarios(size):
+    deep_page = max(size // PAGE_LIMIT - 1, 1)
+    created = []
+
+    def get_users(*args):
+        def op(i):
+            assert UserDatabase.get_users(*args)['data']
+        return op
+
+    def get_by_id(i):
+        assert UserDatabase.get_user_by_id(i * 7919 % size + 1) is not None
+
+    def create(i):
+        created.append(UserDatabase.create_user(f'Db Bench {i}', f'db.bench{i}@example.org', 'User')['id'])
+
+    def update(i):
+        assert UserDatabase.update_user(i * 7919 % size + 1, role='Admin') is not None
+
+    def delete(i):
+        assert UserDatabase.delete_user(created.pop())
+
+    def export(encode):
+        def op(i):
+            for _ in encode(UserDatabase.store().iter_all()):
+                pass
+        return op
+
+    return [
+        Scenario('db.list', get_users('', 1, PAGE_LIMIT, 'id', 'asc')),
+        Scenario('db.search', get_users(SEARCH, 1, PAGE_LIMIT, 'id', 'asc')),
+        Scenario('db.sort', get_users('', 1, PAGE_LIMIT, 'name', 'desc')),
+        Scenario('db.deep_page', get_users('', deep_page, PAGE_LIMIT, 'name', 'asc')),
+        Scenario('db.get_by_id', get_by_id),
+        Scenario('db.create', create, warmup=False),
+        Scenario('db.update', update, warmup=False),
+        Scenario('db.delete', delete, warmup=False),
+        Scenario('db.export_csv', export(iter_csv), EXPORT_ITERATIONS),
+        Scenario('db.export_json', export(iter_json), EXPORT_ITERATIONS),
+    ]
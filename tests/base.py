@@ -0,0 +1,29 @@
+import unittest
+import os
+import tempfile
+from app import create_app
+from app.models import UserDatabase
+
+class AppTestCase(unittest.TestCase):
+    """Base for API tests: apps built by ``_client`` share a temporary data file"""
+    STORAGE = 'json'
+    CONFIG = {}
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _client(self, **config):
+        app = create_app({
+            'TESTING': True,
+            'USER_STORAGE': self.STORAGE,
+            'USER_DATA_PATH': os.path.join(self.temp_dir.name, 'users.' + self.STORAGE),
+            **self.CONFIG,
+            **config,
+        })
+        return app.test_client()
+
+    def _seed(self, client, users):
+        """Replace every user in the store of ``client``'s app"""
+        with client.application.app_context():
+            UserDatabase.save_data(users)
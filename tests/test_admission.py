@@ -0,0 +1,164 @@
+import unittest
+import sqlite3
+import threading
+import time
+from unittest import mock
+from app import metrics
+from app.admission import DEFAULT_POLICIES, AdmissionController, upstream_wait
+from app.models import UserDatabase
+from tests.base import AppTestCase
+
+def policies(**overrides):
+    return {name: {**policy, **overrides.get(name, {})} for name, policy in DEFAULT_POLICIES.items()}
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_limit_queue_and_deadline(self):
+        """Test requests over the limit queue, then time out or are rejected"""
+        controller = AdmissionController(policies(read={'limit': 1, 'queue': 1}))
+        self.assertEqual(controller.acquire('read'), 'admitted')
+        self.assertEqual(controller.acquire('read', timeout=0.01), 'timeout')
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(controller.acquire('read', timeout=5)))
+        waiter.start()
+        while not controller.waiting['read']:
+            time.sleep(0.001)
+        self.assertEqual(controller.acquire('read'), 'rejected')
+        controller.release('read')
+        waiter.join()
+        self.assertEqual(results, ['queued'])
+        self.assertEqual((controller.active['read'], controller.waiting['read']), (1, 0))
+
+    def test_exports_yield_to_queued_writes(self):
+        """Test an export waits while a write is queued, even with a free export slot"""
+        controller = AdmissionController(policies(write={'limit': 1}))
+        controller.acquire('write')
+        writer = threading.Thread(target=controller.acquire, args=('write',))
+        writer.start()
+        while not controller.waiting['write']:
+            time.sleep(0.001)
+        self.assertEqual(controller.acquire('export', timeout=0.01), 'timeout')
+        controller.release('write')
+        writer.join()
+        self.assertEqual(controller.acquire('export', timeout=0.01), 'admitted')
+
+    def test_upstream_wait(self):
+        """Test X-Request-Start is read in seconds, milliseconds or microseconds"""
+        now = 1700000000.5
+        for value in ('t=1700000000.25', '1700000000250', 't=1700000000250000'):
+            self.assertAlmostEqual(upstream_wait(value, now), 0.25, places=3)
+        for value in (None, '', 't=soon', 't=1800000000'):
+            self.assertEqual(upstream_wait(value, now), 0.0)
+        self.assertEqual(AdmissionController(policies()).acquire('read', timeout=-1), 'expired')
+
+class TestAdmissionAPI(AppTestCase):
+    CONFIG = {'QUERY_CACHE_SIZE': 0}
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def _while_busy(self, client, url, check):
+        """Run ``check`` while a request to ``url`` is held inside its view"""
+        entered, release = threading.Event(), threading.Event()
+        original = UserDatabase.get_users
+
+        def blocking(*args, **kwargs):
+            entered.set()
+            release.wait(5)
+            return original(*args, **kwargs)
+
+        with mock.patch.object(UserDatabase, 'get_users', side_effect=blocking):
+            busy = threading.Thread(target=client.get, args=(url,))
+            busy.start()
+            self.assertTrue(entered.wait(5))
+            try:
+                check()
+            finally:
+                release.set()
+                busy.join()
+
+    def test_overload_is_rejected_with_retry_after(self):
+        """Test 429 when the queue is full and 503 when the wait times out"""
+        client = self._client(ADMISSION_POLICIES={'read': {'limit': 1, 'queue': 0}})
+
+        def check():
+            response = client.get('/api/users')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(client.get('/metrics').status_code, 200)
+            self.assertEqual(client.put('/api/users/1', json={'name': 'x'}).status_code, 404)
+
+        self._while_busy(client, '/api/users', check)
+        self.assertEqual(client.get('/api/users').status_code, 200)
+
+        client = self._client(ADMISSION_POLICIES={'read': {'limit': 1, 'timeout': 0.05, 'retry_after': 2}})
+
+        def check():
+            response = client.get('/api/users/1')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '2')
+
+        self._while_busy(client, '/api/users', check)
+        self.assertEqual(metrics.ADMISSIONS.value(('read', 'rejected')), 1)
+        self.assertEqual(metrics.ADMISSIONS.value(('read', 'timeout')), 1)
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('app_admission_decisions_total{route_class="read",decision="timeout"} 1', body)
+        self.assertIn('app_admission_queue_depth{route_class="read"} 0', body)
+
+    def test_requests_that_queued_upstream_past_their_deadline_are_shed(self):
+        """Test time spent before reaching the app counts against the deadline"""
+        client = self._client()
+        stale = {'X-Request-Start': f't={time.time() - 10:.3f}'}
+        response = client.get('/api/users', headers=stale)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(metrics.ADMISSIONS.value(('read', 'expired')), 1)
+        fresh = {'X-Request-Start': f't={time.time():.3f}'}
+        self.assertEqual(client.get('/api/users', headers=fresh).status_code, 200)
+
+    def test_streamed_export_holds_its_slot_until_sent(self):
+        """Test an export's slot is released once its body has been read"""
+        client = self._client(ADMISSION_POLICIES={'export': {'limit': 1, 'queue': 0}})
+        first = client.get('/api/users/export')
+        self.assertEqual(client.get('/api/users/export').status_code, 429)
+        first.get_data()
+        self.assertEqual(client.get('/api/users/export').status_code, 200)
+
+    def test_change_streams_are_capped(self):
+        """Test open change streams past the limit are rejected until one closes"""
+        client = self._client(ADMISSION_POLICIES={'stream': {'limit': 1}})
+        first = client.get('/api/users/changes/stream')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(client.get('/api/users/changes/stream').status_code, 429)
+        first.close()
+        second = client.get('/api/users/changes/stream')
+        self.assertEqual(second.status_code, 200)
+        second.close()
+
+    def test_busy_database_is_503(self):
+        """Test SQLite lock timeouts are reported as overload"""
+        client = self._client()
+        with mock.patch.object(UserDatabase, 'get_user_by_id',
+                               side_effect=sqlite3.OperationalError('database is locked')):
+            response = client.get('/api/users/1')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_decisions_are_not_recorded_without_metrics(self):
+        """Test admission records nothing when METRICS_ENABLED is false"""
+        client = self._client(METRICS_ENABLED=False, ADMISSION_POLICIES={'read': {'limit': 1, 'queue': 0}})
+        self._while_busy(client, '/api/users', lambda: client.get('/api/users'))
+        self.assertEqual(metrics.ADMISSIONS.value(('read', 'admitted')), 0)
+        self.assertEqual(metrics.ADMISSIONS.value(('read', 'rejected')), 0)
+        self.assertEqual(metrics.PHASE_SECONDS.count(('background', 'admission.wait')), 0)
+
+    def test_disabled(self):
+        """Test ADMISSION_ENABLED=false installs no admission control"""
+        client = self._client(ADMISSION_ENABLED=False)
+        self.assertNotIn('admission', client.application.extensions)
+        self.assertEqual(client.get('/api/users').status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
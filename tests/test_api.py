@@ -1,21 +1,31 @@
 import unittest
+import csv
+import gzip
 import json
+from io import BytesIO, StringIO
 from app import create_app
+from app.formats import iter_json
 from app.models import UserDatabase
 import tempfile
+import time
 import os
+from unittest import mock
 
 class TestUserManagementAPI(unittest.TestCase):
+    STORAGE = 'json'
+    COMPACT_RECORDS = False
     
     def setUp(self):
         """Set up test client and database"""
-        self.app = create_app()
-        self.app.config['TESTING'] = True
-        self.client = self.app.test_client()
-        
         # Use a temporary database for tests
-        self.temp_db = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
-        self.temp_db.close()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'USER_STORAGE': self.STORAGE,
+            'USER_DATA_PATH': os.path.join(self.temp_dir.name, 'users.' + self.STORAGE),
+            'USER_COMPACT_RECORDS': self.COMPACT_RECORDS,
+        })
+        self.client = self.app.test_client()
         
         # Initialize test data
         self._init_test_data()
@@ -27,12 +37,12 @@ class TestUserManagementAPI(unittest.TestCase):
             {"id": 2, "name": "Test User 2", "email": "test2@example.com", "role": "User"},
             {"id": 3, "name": "Test User 3", "email": "test3@example.com", "role": "Manager"},
         ]
-        UserDatabase.save_data(test_users)
+        with self.app.app_context():
+            UserDatabase.save_data(test_users)
     
     def tearDown(self):
         """Clean up after tests"""
-        if os.path.exists(self.temp_db.name):
-            os.unlink(self.temp_db.name)
+        self.temp_dir.cleanup()
     
     # GET /api/users tests
     def test_get_users_success(self):
@@ -68,6 +78,31 @@ class TestUserManagementAPI(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['data'][0]['name'], 'Test User 3')
     
+    def test_get_users_with_cursor(self):
+        """Test keyset pagination walks every user exactly once"""
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get('/api/users', query_string={
+                'cursor': cursor, 'limit': 2, 'sort_by': 'name', 'order': 'desc'})
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertEqual(data['total'], 3)
+            self.assertNotIn('page', data)
+            seen.extend(u['name'] for u in data['data'])
+            cursor = data['next_cursor']
+        self.assertEqual(seen, ['Test User 3', 'Test User 2', 'Test User 1'])
+    
+    def test_get_users_with_invalid_cursor(self):
+        """Test a malformed or mismatched cursor is rejected"""
+        response = self.client.get('/api/users?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        
+        data = json.loads(self.client.get('/api/users?cursor=&limit=1&sort_by=name').data)
+        response = self.client.get('/api/users', query_string={
+            'cursor': data['next_cursor'], 'sort_by': 'email'})
+        self.assertEqual(response.status_code, 400)
+    
     def test_get_user_by_id(self):
         """Test getting a specific user"""
         response = self.client.get('/api/users/1')
@@ -144,6 +179,33 @@ class TestUserManagementAPI(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 404)
     
+    def test_create_user_duplicate_email(self):
+        """Test creating a user with an email that is already taken"""
+        response = self.client.post('/api/users',
+            data=json.dumps({
+                'name': 'Copy',
+                'email': 'TEST1@example.com',
+                'role': 'User'
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 409)
+    
+    def test_update_user_duplicate_email(self):
+        """Test updating a user to another user's email"""
+        response = self.client.put('/api/users/1',
+            data=json.dumps({'email': 'test2@example.com'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 409)
+        
+        # Keeping one's own email is not a conflict
+        response = self.client.put('/api/users/1',
+            data=json.dumps({'email': 'test1@example.com', 'name': 'Same Email'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+    
     def test_update_user_partial(self):
         """Test partial update"""
         response = self.client.put('/api/users/1',
@@ -169,6 +231,210 @@ class TestUserManagementAPI(unittest.TestCase):
         response = self.client.delete('/api/users/999')
         self.assertEqual(response.status_code, 404)
     
+    def test_apps_keep_their_own_store(self):
+        """Test creating another app does not change the store this one uses"""
+        other_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(other_dir.cleanup)
+        other = create_app({'TESTING': True, 'USER_DATA_PATH': os.path.join(other_dir.name, 'users.json')})
+        self.assertEqual(self.client.get('/api/users').get_json()['total'], 3)
+        self.assertEqual(other.test_client().get('/api/users').get_json()['total'], 0)
+    
+    # Conditional request tests
+    def test_get_users_not_modified(self):
+        """Test If-None-Match answers 304 without running the query"""
+        response = self.client.get('/api/users?page=1')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        with mock.patch.object(self.app.extensions['user_store'], 'query') as query:
+            response = self.client.get('/api/users?page=1', headers={'If-None-Match': etag})
+            query.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        
+        self.client.delete('/api/users/3')
+        response = self.client.get('/api/users?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+    
+    def test_get_users_if_modified_since(self):
+        """Test If-Modified-Since answers 304 once the last write is a second old"""
+        # Written this second: another write may still follow within it
+        last_modified = self.client.get('/api/users').headers['Last-Modified']
+        response = self.client.get('/api/users', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        with mock.patch.object(UserDatabase, 'last_modified', return_value=time.time() - 5):
+            last_modified = self.client.get('/api/users').headers['Last-Modified']
+            response = self.client.get('/api/users', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+    
+    def test_get_user_not_modified(self):
+        """Test a single user's ETag follows its content"""
+        etag = self.client.get('/api/users/1').headers['ETag']
+        response = self.client.get('/api/users/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        
+        # Changes to other users do not invalidate it
+        self.client.put('/api/users/2', data=json.dumps({'name': 'Other'}), content_type='application/json')
+        response = self.client.get('/api/users/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+    
+    def test_update_user_if_match(self):
+        """Test optimistic concurrency with If-Match"""
+        etag = self.client.get('/api/users/1').headers['ETag']
+        first = self.client.put('/api/users/1', data=json.dumps({'name': 'First'}),
+            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(first.status_code, 200)
+        
+        stale = self.client.put('/api/users/1', data=json.dumps({'name': 'Second'}),
+            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(stale.status_code, 412)
+        
+        response = self.client.delete('/api/users/1', headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        response = self.client.delete('/api/users/1', headers={'If-Match': first.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_export_not_modified(self):
+        """Test conditional export requests"""
+        etag = self.client.get('/api/users/export?format=csv').headers['ETag']
+        response = self.client.get('/api/users/export?format=csv', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+    
+    # Bulk tests
+    def test_bulk_create(self):
+        """Test creating several users in one request"""
+        response = self.client.post('/api/users/bulk',
+            data=json.dumps([
+                {'name': 'Bulk 1', 'email': 'bulk1@example.com', 'role': 'User'},
+                {'name': 'Bulk 2', 'email': 'bulk2@example.com', 'role': 'Admin'}
+            ]),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data)
+        self.assertEqual(data['succeeded'], 2)
+        self.assertEqual([r['user']['id'] for r in data['results']], [4, 5])
+    
+    def test_bulk_create_ndjson_best_effort(self):
+        """Test NDJSON bulk create keeps the valid items"""
+        body = '\n'.join(json.dumps(item) for item in [
+            {'name': 'Bulk 1', 'email': 'bulk1@example.com', 'role': 'User'},
+            {'name': 'No Email', 'role': 'User'},
+            {'name': 'Dup', 'email': 'bulk1@example.com', 'role': 'User'}
+        ])
+        response = self.client.post('/api/users/bulk', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 207)
+        data = json.loads(response.data)
+        self.assertEqual([r['status'] for r in data['results']], [201, 400, 409])
+        self.assertEqual(self.client.get('/api/users/4').status_code, 200)
+    
+    def test_bulk_create_atomic_rolls_back(self):
+        """Test all-or-nothing mode applies nothing when one item fails"""
+        response = self.client.post('/api/users/bulk?atomic=true',
+            data=json.dumps([
+                {'name': 'Bulk 1', 'email': 'bulk1@example.com', 'role': 'User'},
+                {'name': 'Bad', 'email': 'not-an-email', 'role': 'User'}
+            ]),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertFalse(data['applied'])
+        self.assertEqual([r['status'] for r in data['results']], [424, 400])
+        self.assertEqual(json.loads(self.client.get('/api/users').data)['total'], 3)
+    
+    def test_bulk_update_and_delete(self):
+        """Test bulk PATCH and DELETE"""
+        response = self.client.patch('/api/users/bulk',
+            data=json.dumps([{'id': 1, 'role': 'User'}, {'id': 2, 'name': 'Renamed'}, {'id': 99, 'name': 'X'}]),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 207)
+        data = json.loads(response.data)
+        self.assertEqual([r['status'] for r in data['results']], [200, 200, 404])
+        self.assertEqual(json.loads(self.client.get('/api/users/2').data)['name'], 'Renamed')
+        
+        response = self.client.delete('/api/users/bulk',
+            data=json.dumps([1, {'id': 2}]),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.client.get('/api/users').data)['total'], 1)
+    
+    def test_bulk_invalid_body(self):
+        """Test bulk endpoints reject bodies that are not arrays"""
+        response = self.client.post('/api/users/bulk', data='{"name": "x"}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+    
+    # Import tests
+    def test_import_round_trip_csv(self):
+        """Test export then import into an empty store reproduces the export"""
+        exported = self.client.get('/api/users/export?format=csv').data
+        with self.app.app_context():
+            UserDatabase.save_data([])
+        response = self.client.post('/api/users/import?chunk_size=2', data=exported, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual((data['processed'], data['created'], data['chunks']), (3, 3, 2))
+        self.assertEqual(self.client.get('/api/users/export?format=csv').data, exported)
+        
+        # Importing the same file again changes nothing
+        self.client.post('/api/users/import', data=exported, content_type='text/csv')
+        self.assertEqual(self.client.get('/api/users/export?format=csv').data, exported)
+    
+    def test_import_round_trip_ndjson(self):
+        """Test NDJSON export/import round trip via a multipart upload"""
+        exported = self.client.get('/api/users/export?format=ndjson').data
+        with self.app.app_context():
+            UserDatabase.save_data([])
+        response = self.client.post('/api/users/import',
+            data={'file': (BytesIO(exported), 'users.ndjson')},
+            content_type='multipart/form-data'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/users/export?format=ndjson').data, exported)
+    
+    def test_import_reports_errors_per_line(self):
+        """Test invalid rows are reported with their line numbers"""
+        body = (
+            'id,name,email,role\n'
+            ',New User,new@example.com,User\n'
+            'abc,Bad Id,bad@example.com,User\n'
+            ',No Email,,User\n'
+            ',Dup,test1@example.com,User\n'
+        )
+        response = self.client.post('/api/users/import', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 207)
+        data = json.loads(response.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([(e['line'], e['status']) for e in data['errors']], [(3, 400), (4, 400), (5, 409)])
+    
+    def test_import_missing_columns(self):
+        """Test a CSV without the required columns is rejected"""
+        response = self.client.post('/api/users/import', data='id,name\n1,x\n', content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_import_malformed_csv_mid_stream(self):
+        """Test a malformed CSV row stops the import but keeps committed chunks"""
+        with self.app.app_context():
+            UserDatabase.save_data([])
+        rows = ''.join(f',User {i},user{i}@example.com,User\n' for i in range(3))
+        body = 'id,name,email,role\n' + rows + ',' + 'x' * (csv.field_size_limit() + 1) + ',big@example.com,User\n'
+        response = self.client.post('/api/users/import?chunk_size=3', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual((data['created'], data['chunks']), (3, 1))
+        self.assertIn('CSV line', data['error'])
+        self.assertEqual(json.loads(self.client.get('/api/users').data)['total'], 3)
+    
+    def test_import_malformed_csv_first_row(self):
+        """Test a malformed first CSV row is a 400, not a server error"""
+        body = 'id,name,email,role\n,' + 'x' * (csv.field_size_limit() + 1) + ',big@example.com,User\n'
+        response = self.client.post('/api/users/import', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('CSV line', json.loads(response.data)['error'])
+    
     # Export tests
     def test_export_json(self):
         """Test exporting users as JSON"""
@@ -185,10 +451,116 @@ class TestUserManagementAPI(unittest.TestCase):
         self.assertIn('text/csv', response.content_type)
         self.assertIn('name', response.data.decode())
     
+    def test_export_matches_previous_output(self):
+        """Test streamed exports are byte-identical to the buffered ones"""
+        with self.app.app_context():
+            users = UserDatabase.load_data()
+        response = self.client.get('/api/users/export?format=json')
+        self.assertEqual(response.data.decode(), json.dumps(users, indent=2))
+        
+        output = StringIO()
+        writer = csv.DictWriter(output, fieldnames=['id', 'name', 'email', 'role'])
+        writer.writeheader()
+        writer.writerows(users)
+        response = self.client.get('/api/users/export?format=csv')
+        self.assertEqual(response.data.decode(), output.getvalue())
+        
+        self.assertEqual(''.join(iter_json(users, chunk_rows=1)), json.dumps(users, indent=2))
+        self.assertEqual(''.join(iter_json([])), json.dumps([], indent=2))
+    
+    def test_export_compact_json(self):
+        """Test compact JSON exports have no indentation and their own ETag"""
+        with self.app.app_context():
+            users = UserDatabase.load_data()
+        response = self.client.get('/api/users/export?format=json&compact=true')
+        self.assertEqual(response.data.decode(), json.dumps(users, separators=(',', ':')))
+        self.assertNotEqual(response.headers['ETag'], self.client.get('/api/users/export').headers['ETag'])
+        self.assertEqual(''.join(iter_json([], compact=True)), '[]')
+    
+    def test_export_ndjson_with_fields(self):
+        """Test NDJSON export with a field selection"""
+        response = self.client.get('/api/users/export?format=ndjson&fields=id,email')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(lines[0], {'id': 1, 'email': 'test1@example.com'})
+        self.assertEqual(len(lines), 3)
+    
+    def test_export_invalid_fields(self):
+        """Test export with an unknown field"""
+        response = self.client.get('/api/users/export?format=csv&fields=id,password')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_export_gzip(self):
+        """Test on-the-fly gzip via the query string and Accept-Encoding"""
+        plain = self.client.get('/api/users/export?format=csv').data
+        response = self.client.get('/api/users/export?format=csv&compress=gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain)
+        
+        response = self.client.get('/api/users/export?format=csv',
+                                   headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(gzip.decompress(response.data), plain)
+    
     def test_export_invalid_format(self):
         """Test export with invalid format"""
         response = self.client.get('/api/users/export?format=xml')
         self.assertEqual(response.status_code, 400)
 
+    # Change feed tests
+    def test_changes_since_listing_version(self):
+        """Test writes after a listing's X-Data-Version are returned in order"""
+        version = int(self.client.get('/api/users').headers['X-Data-Version'])
+        self.client.put('/api/users/1', json={'name': 'Renamed'})
+        self.client.delete('/api/users/2')
+        response = self.client.get(f'/api/users/changes?since={version}')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual([c['op'] for c in data['changes']], ['put', 'delete'])
+        self.assertEqual(data['changes'][0]['user']['name'], 'Renamed')
+        self.assertEqual(data['changes'][1]['id'], 2)
+        self.assertEqual(data['version'], int(self.client.get('/api/users').headers['X-Data-Version']))
+        self.assertFalse(data['has_more'])
+        
+        data = self.client.get(f'/api/users/changes?since={data["version"]}').get_json()
+        self.assertEqual(data['changes'], [])
+    
+    def test_changes_invalid_since(self):
+        """Test a missing or unknown version is rejected"""
+        self.assertEqual(self.client.get('/api/users/changes').status_code, 400)
+        self.assertEqual(self.client.get('/api/users/changes?since=abc').status_code, 400)
+        response = self.client.get('/api/users/changes?since=999999')
+        self.assertEqual(response.status_code, 410)
+        self.assertIn('version', response.get_json())
+    
+    def test_changes_stream(self):
+        """Test the event stream sends pending changes as events"""
+        self.app.config['CHANGES_STREAM_TIMEOUT'] = 0
+        version = int(self.client.get('/api/users').headers['X-Data-Version'])
+        self.client.put('/api/users/3', json={'role': 'Admin'})
+        response = self.client.get('/api/users/changes/stream', headers={'Last-Event-ID': str(version)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.get_data(as_text=True).strip().split('\n\n')
+        self.assertEqual(events[0], f'event: ready\ndata: {{"version": {version}}}')
+        event_id, data = events[1].split('\n')
+        change = json.loads(data[len('data: '):])
+        self.assertEqual(event_id, f'id: {change["seq"]}')
+        self.assertEqual((change['op'], change['user']['role']), ('put', 'Admin'))
+        self.assertEqual(len(events), 2)
+    
+    def test_changes_stream_reset(self):
+        """Test a version outside the change log ends the stream with a reset event"""
+        response = self.client.get('/api/users/changes/stream?since=999999')
+        self.assertIn('event: reset', response.get_data(as_text=True))
+    
+class TestUserManagementAPISQLite(TestUserManagementAPI):
+    """Run the same API tests against the SQLite backend"""
+    STORAGE = 'sqlite'
+
+class TestUserManagementAPICompactRecords(TestUserManagementAPI):
+    """Run the same API tests with the JSON store's compact records"""
+    COMPACT_RECORDS = True
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import json
+import os
+from unittest import mock
+from app import metrics
+from app.cache import QueryCache
+from app.models import UserDatabase
+from tests.base import AppTestCase
+
+def events(event):
+    return metrics.CACHE_EVENTS.value((event,))
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.cache = QueryCache(max_entries=2, ttl=10)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Test the cache keeps at most max_entries, dropping the oldest use"""
+        self.cache.put(1, 'a', b'A')
+        self.cache.put(1, 'b', b'B')
+        self.assertEqual(self.cache.get(1, 'a'), b'A')
+        self.cache.put(1, 'c', b'C')
+        self.assertIsNone(self.cache.get(1, 'b'))
+        self.assertEqual(self.cache.get(1, 'a'), b'A')
+        self.assertEqual(self.cache.get(1, 'c'), b'C')
+        self.assertEqual((events('hit'), events('miss'), events('eviction')), (3, 1, 1))
+
+    def test_entries_expire(self):
+        """Test entries are dropped after the TTL"""
+        with mock.patch('app.cache.time.monotonic', return_value=100.0):
+            self.cache.put(1, 'a', b'A')
+        with mock.patch('app.cache.time.monotonic', return_value=109.0):
+            self.assertEqual(self.cache.get(1, 'a'), b'A')
+        with mock.patch('app.cache.time.monotonic', return_value=110.5):
+            self.assertIsNone(self.cache.get(1, 'a'))
+        self.assertEqual(events('expired'), 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_new_version_invalidates(self):
+        """Test a new data version drops every entry and stale puts are ignored"""
+        self.cache.put(1, 'a', b'A')
+        self.assertIsNone(self.cache.get(2, 'a'))
+        self.assertEqual(events('invalidated'), 1)
+        self.cache.put(1, 'a', b'old')
+        self.assertIsNone(self.cache.get(2, 'a'))
+
+    def test_large_values_are_not_cached(self):
+        """Test values over max_value_bytes are skipped"""
+        cache = QueryCache(max_value_bytes=4)
+        cache.put(1, 'a', b'12345')
+        self.assertEqual(len(cache), 0)
+
+class TestQueryCacheAPI(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self._client()
+        self._seed(self.client, [
+            {"id": 1, "name": "Test User 1", "email": "test1@example.com", "role": "Admin"},
+            {"id": 2, "name": "Test User 2", "email": "test2@example.com", "role": "User"},
+        ])
+        metrics.reset()
+
+    def test_repeated_listing_is_served_from_cache(self):
+        """Test equivalent listings share one cached response body"""
+        first = self.client.get('/api/users?search=USER&sort_by=name&order=DESC')
+        with mock.patch.object(UserDatabase, 'get_users') as get_users:
+            second = self.client.get('/api/users?search=user&sort_by=name&order=desc')
+            get_users.assert_not_called()
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Content-Type'], first.headers['Content-Type'])
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual((events('hit'), events('miss')), (1, 1))
+
+    def test_writes_invalidate(self):
+        """Test a listing reflects a write made after it was cached"""
+        self.client.get('/api/users')
+        self.client.post('/api/users', json={'name': 'New', 'email': 'new@example.com', 'role': 'User'})
+        data = self.client.get('/api/users').get_json()
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(events('hit'), 0)
+
+    def test_external_rewrites_invalidate(self):
+        """Test replacing users.json outside the app is never answered from the cache"""
+        path = os.path.join(self.temp_dir.name, 'users.json')
+        etag = ''
+        for name in ('Replaced', 'Replaced again'):
+            if os.path.exists(path + '.journal'):
+                os.remove(path + '.journal')
+            with open(path, 'w') as f:
+                json.dump([{"id": 1, "name": name, "email": "r@example.com", "role": "User"}], f)
+            response = self.client.get('/api/users', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['data'][0]['name'], name)
+            etag = response.headers['ETag']
+
+    def test_disabled(self):
+        """Test QUERY_CACHE_SIZE=0 turns the cache off"""
+        client = self._client(QUERY_CACHE_SIZE=0)
+        client.get('/api/users')
+        client.get('/api/users')
+        self.assertEqual((events('hit'), events('miss')), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
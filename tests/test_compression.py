@@ -0,0 +1,88 @@
+import unittest
+import gzip
+import os
+import re
+import zlib
+from tests.base import AppTestCase
+
+class TestCompression(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self._client()
+        self._seed(self.client, [
+            {"id": i, "name": f"Test User {i}", "email": f"test{i}@example.com", "role": "User"}
+            for i in range(1, 51)
+        ])
+
+    def test_large_json_is_gzipped(self):
+        """Test listings over the threshold are gzipped with a weak ETag that still validates"""
+        plain = self.client.get('/api/users?limit=50')
+        response = self.client.get('/api/users?limit=50', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data) // 3)
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+
+        revalidated = self.client.get('/api/users?limit=50', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_deflate_when_preferred(self):
+        """Test deflate is used when the client prefers it"""
+        response = self.client.get('/api/users?limit=50', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), self.client.get('/api/users?limit=50').data)
+
+    def test_skipped_responses(self):
+        """Test small, streamed and disallowed responses are left alone"""
+        headers = {'Accept-Encoding': 'gzip'}
+        self.assertNotIn('Content-Encoding', self.client.get('/api/users/1', headers=headers).headers)
+        export = self.client.get('/api/users/export?compress=none', headers=headers)
+        self.assertNotIn('Content-Encoding', export.headers)
+        client = self._client(COMPRESSION_MIMETYPES=('text/html',))
+        self.assertNotIn('Content-Encoding', client.get('/api/users?limit=50', headers=headers).headers)
+        client = self._client(COMPRESSION_ENABLED=False)
+        self.assertNotIn('Content-Encoding', client.get('/api/users?limit=50', headers=headers).headers)
+
+    def test_compact_json(self):
+        """Test API responses are not indented, even in debug mode"""
+        client = self._client(DEBUG=True)
+        self.assertNotIn(b'\n  ', client.get('/api/users').data)
+        client = self._client(DEBUG=True, JSON_COMPACT=None)
+        self.assertIn(b'\n  ', client.get('/api/users').data)
+
+class TestAssets(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self._client()
+
+    def test_dashboard_links_fingerprinted_assets(self):
+        """Test the dashboard links app.js by content hash and is always revalidated"""
+        page = self.client.get('/')
+        self.assertIn('no-cache', page.headers['Cache-Control'])
+        url = re.search(r'src="(/assets/js/app\.[0-9a-f]{12}\.js)"', page.get_data(as_text=True)).group(1)
+
+        with open(os.path.join(os.path.dirname(__file__), '..', 'app', 'static', 'js', 'app.js'), 'rb') as f:
+            source = f.read()
+        response = self.client.get(url)
+        self.assertEqual(response.data, source)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), source)
+
+        response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_fingerprint(self):
+        """Test stale or made-up fingerprints are not served"""
+        self.assertEqual(self.client.get('/assets/js/app.000000000000.js').status_code, 404)
+        self.assertEqual(self.client.get('/assets/js/app.js').status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+from app.fragments import FragmentCache
+from tests.base import AppTestCase
+
+class TestFragmentCache(unittest.TestCase):
+
+    def test_fragments_are_reused_until_the_record_changes(self):
+        """Test a user is encoded again only after it changed"""
+        encode = mock.Mock(side_effect=lambda user: user['name'])
+        cached = FragmentCache().encoder(encode)
+        user = {'id': 1, 'name': 'Alice'}
+        self.assertEqual([cached(user), cached(dict(user))], ['Alice', 'Alice'])
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(cached({'id': 1, 'name': 'Alicia'}), 'Alicia')
+        self.assertEqual(encode.call_count, 2)
+
+    def test_least_recently_used_fragments_are_evicted(self):
+        """Test at most max_entries fragments are kept per encoder, dropping the oldest use"""
+        cache = FragmentCache(max_entries=2)
+        encode = mock.Mock(side_effect=str)
+        cached = cache.encoder(encode)
+        users = [{'id': i} for i in range(3)]
+        cached(users[0])
+        cached(users[1])
+        cached(users[0])
+        cached(users[2])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(encode.call_count, 3)
+        cached(users[0])
+        self.assertEqual(encode.call_count, 3)
+        cached(users[1])
+        self.assertEqual(encode.call_count, 4)
+        cache.encoder(repr)(users[2])
+        self.assertEqual(len(cache), 3)
+
+    def test_deleted_users_are_dropped(self):
+        """Test discard removes a user's fragments for every encoder"""
+        cache = FragmentCache()
+        for encode in (str, repr):
+            cache.encoder(encode)({'id': 1})
+            cache.encoder(encode)({'id': 2})
+        cache.discard([1, 99])
+        self.assertEqual(len(cache), 2)
+
+class TestFragmentResponses(AppTestCase):
+    CONFIG = {'QUERY_CACHE_SIZE': 0}
+
+    def setUp(self):
+        super().setUp()
+        self.clients = [self._client(), self._client(JSON_FRAGMENT_CACHE_SIZE=0)]
+        self._seed(self.clients[0], [
+            {"id": 1, "name": "Zoë \"Z\" Ünal", "email": "zoe@example.com", "role": "Admin"},
+            {"id": 2, "name": "Test User 2", "email": "test2@example.com", "role": "User"},
+            {"id": 3, "name": "日本 太郎", "email": "taro@example.com", "role": "Manager"},
+        ])
+
+    def assertSameBody(self, url):
+        cached, plain = (client.get(url) for client in self.clients)
+        self.assertEqual(cached.status_code, plain.status_code, url)
+        self.assertEqual(cached.data, plain.data, url)
+        self.assertEqual(cached.headers['Content-Type'], plain.headers['Content-Type'], url)
+
+    def test_responses_match_jsonify(self):
+        """Test responses built from fragments are byte-identical to re-encoded ones"""
+        for url in ('/api/users', '/api/users?limit=2&page=2', '/api/users?search=zz',
+                    '/api/users?sort_by=name&order=desc&cursor=', '/api/users?limit=1&cursor=',
+                    '/api/users/1', '/api/users/3', '/api/users/99'):
+            self.assertSameBody(url)
+            self.assertSameBody(url)
+        self.assertGreater(len(self.clients[0].application.extensions['json_fragments']), 0)
+
+    def test_changed_records_are_encoded_again(self):
+        """Test a write shows up in responses served from fragments"""
+        client = self.clients[0]
+        client.get('/api/users')
+        client.put('/api/users/2', json={'name': 'Renamed'})
+        self.assertSameBody('/api/users')
+        self.assertSameBody('/api/users/2')
+
+    def test_deletes_drop_fragments(self):
+        """Test deleted users do not keep their fragments"""
+        client = self.clients[0]
+        fragments = client.application.extensions['json_fragments']
+        client.get('/api/users')
+        self.assertEqual(len(fragments), 3)
+        client.delete('/api/users/1')
+        client.delete('/api/users/bulk', json=[2, 99])
+        self.assertEqual(len(fragments), 1)
+
+    def test_debug_output_is_indented(self):
+        """Test fragments are bypassed when jsonify would indent"""
+        client = self._client(DEBUG=True, JSON_COMPACT=None)
+        self.assertIn(b'\n  "data": [', client.get('/api/users').data)
+
+class TestFragmentResponsesSQLite(TestFragmentResponses):
+    STORAGE = 'sqlite'
+
+if __name__ == '__main__':
+    unittest.main()
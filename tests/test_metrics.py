@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+from app import metrics
+from tests.base import AppTestCase
+
+class TestMetrics(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self._client()
+        self._seed(self.client, [
+            {"id": 1, "name": "Test User 1", "email": "test1@example.com", "role": "Admin"},
+            {"id": 2, "name": "Test User 2", "email": "test2@example.com", "role": "User"},
+        ])
+        metrics.reset()
+
+    def test_requests_and_phases_are_exported(self):
+        """Test /metrics reports request counts, latency and phases"""
+        self.client.get('/api/users?search=user&sort_by=name')
+        self.client.get('/api/users/99')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('app_http_requests_total{method="GET",endpoint="api.get_users",status="200"} 1', body)
+        self.assertIn('app_http_requests_total{method="GET",endpoint="api.get_user",status="404"} 1', body)
+        self.assertIn('app_http_request_duration_seconds_count{method="GET",endpoint="api.get_users"} 1', body)
+        self.assertIn('app_http_request_duration_seconds_bucket{method="GET",endpoint="api.get_users",le="+Inf"} 1', body)
+        for phase in ('query', 'storage.search', 'storage.sort', 'serialize'):
+            self.assertIn(f'app_phase_duration_seconds_count{{endpoint="api.get_users",phase="{phase}"}} 1', body)
+
+    def test_streamed_response_is_counted_when_finished(self):
+        """Test exports are timed including the streamed body"""
+        response = self.client.get('/api/users/export?format=csv')
+        response.get_data()
+        response.close()
+        self.assertEqual(metrics.REQUESTS.value(('GET', 'api.export_users', '200')), 1)
+
+    def test_server_errors_are_counted(self):
+        """Test exceptions caught by the API handlers are counted by type"""
+        with mock.patch.object(self.client.application.extensions['user_store'], 'query', side_effect=RuntimeError('boom')):
+            response = self.client.get('/api/users')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(metrics.ERRORS.value(('api.get_users', 'RuntimeError')), 1)
+        self.assertEqual(metrics.REQUESTS.value(('GET', 'api.get_users', '500')), 1)
+
+    def test_slow_request_log(self):
+        """Test slow requests are logged with their phase breakdown"""
+        client = self._client(METRICS_SLOW_REQUEST_MS=0)
+        with self.assertLogs('app.metrics', 'WARNING') as logs:
+            client.get('/api/users')
+        self.assertIn('GET /api/users 200', logs.output[0])
+        self.assertIn('query=', logs.output[0])
+
+    def test_disabled(self):
+        """Test disabled metrics install no hooks and record nothing"""
+        client = self._client(METRICS_ENABLED=False)
+        with client.application.app_context():
+            self.assertIs(metrics.span('query'), metrics._NOOP)
+        self.assertEqual(client.get('/api/users').status_code, 200)
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        body = metrics.render()
+        self.assertNotIn('app_http_requests_total{', body)
+        self.assertNotIn('app_phase_duration_seconds_count{', body)
+        
+        # The app created earlier keeps recording
+        self.client.get('/api/users?search=user')
+        self.assertEqual(metrics.REQUESTS.value(('GET', 'api.get_users', '200')), 1)
+        self.assertEqual(metrics.PHASE_SECONDS.count(('api.get_users', 'query')), 1)
+    
+    def test_slow_request_threshold_is_per_app(self):
+        """Test a later app does not change an earlier app's slow request threshold"""
+        client = self._client(METRICS_SLOW_REQUEST_MS=0)
+        self._client()
+        with self.assertLogs('app.metrics', 'WARNING') as logs:
+            client.get('/api/users')
+        self.assertIn('GET /api/users 200', logs.output[0])
+
+if __name__ == '__main__':
+    unittest.main()
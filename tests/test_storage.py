@@ -0,0 +1,500 @@
+import unittest
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from app import storage
+from app.migrate import migrate
+from app.sqlite_store import SQLiteStore
+from app.storage import ChangeLogGoneError, JsonFileStore, UserRecord
+
+WORKERS = 4
+WRITES_PER_WORKER = 40
+
+def _stress_worker(path, worker, queue):
+    """Create users and repeatedly update this worker's own user"""
+    store = JsonFileStore(path, compact_ops=25)
+    created = []
+    lock = threading.Lock()
+
+    def run(thread):
+        for i in range(WRITES_PER_WORKER // 2):
+            tag = 'w%d-t%d-%d' % (worker, thread, i)
+            user = store.create(tag, tag + '@example.com', 'User')
+            store.update(worker + 1, name='worker %d thread %d write %d' % (worker, thread, i))
+            with lock:
+                created.append(user['id'])
+
+    threads = [threading.Thread(target=run, args=(t,)) for t in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    queue.put((worker, created))
+
+class TestJsonFileStore(unittest.TestCase):
+    
+    def setUp(self):
+        """Create a store backed by a temporary users file"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.json')
+        with open(self.path, 'w') as f:
+            json.dump([
+                {"id": 1, "name": "Test User 1", "email": "test1@example.com", "role": "Admin"},
+                {"id": 2, "name": "Test User 2", "email": "test2@example.com", "role": "User"},
+            ], f)
+        self.store = JsonFileStore(self.path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_reads_are_served_from_memory(self):
+        """Test the file is parsed only once while it is unchanged"""
+        self.assertEqual(len(self.store.all()), 2)
+        with mock.patch('app.storage.json.load') as load:
+            self.store.all()
+            self.store.get(1)
+            load.assert_not_called()
+    
+    def test_reloads_after_external_change(self):
+        """Test a rewrite by another process is picked up"""
+        self.assertEqual(len(self.store.all()), 2)
+        with open(self.path, 'w') as f:
+            json.dump([{"id": 7, "name": "Other", "email": "o@example.com", "role": "User"}], f)
+        self.assertEqual([u['id'] for u in self.store.all()], [7])
+    
+    def test_data_tag_changes_on_every_reload(self):
+        """Test the data tag changes on external rewrites although the version restarts"""
+        tags = [self.store.data_tag()]
+        for name in ('Other', 'Another'):
+            with open(self.path, 'w') as f:
+                json.dump([{"id": 7, "name": name, "email": "o@example.com", "role": "User"}], f)
+            self.store.refresh()
+            self.assertEqual(self.store.version, 0)
+            tags.append(self.store.data_tag())
+        self.assertEqual(len(set(tags)), 3)
+        other = JsonFileStore(self.path)
+        other.refresh()
+        self.assertEqual(other.data_tag(), tags[-1])
+        self.store.update(7, name='Renamed')
+        self.assertNotEqual(self.store.data_tag(), tags[-1])
+    
+    def test_writes_update_memory_and_disk(self):
+        """Test mutations are visible in memory and survive a restart"""
+        created = self.store.create('New', 'new@example.com', 'User')
+        self.assertEqual(created['id'], 3)
+        self.store.update(1, name='Renamed')
+        self.store.delete(2)
+        reopened = JsonFileStore(self.path)
+        self.assertEqual(reopened.all(), self.store.all())
+        self.assertEqual([u['name'] for u in reopened.all()], ['Renamed', 'New'])
+        self.assertEqual(reopened.version, self.store.version)
+    
+    def test_writes_append_to_journal(self):
+        """Test a write appends one journal record instead of rewriting the snapshot"""
+        with open(self.path) as f:
+            before = f.read()
+        self.store.update(1, name='Renamed')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), before)
+        with open(self.store.journal_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['op'], 'put')
+        self.assertEqual(records[0]['user']['name'], 'Renamed')
+    
+    def test_compaction_folds_journal_into_snapshot(self):
+        """Test compaction writes a new snapshot and keeps the state"""
+        self.store.create('New', 'new@example.com', 'User')
+        self.store.delete(1)
+        self.assertTrue(self.store.compact())
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), self.store.all())
+        with open(self.store.journal_path) as f:
+            self.assertEqual([json.loads(line)['op'] for line in f], ['base'])
+        reopened = JsonFileStore(self.path)
+        self.assertEqual(reopened.all(), self.store.all())
+        self.assertEqual(reopened.version, self.store.version)
+    
+    def test_replaying_journal_over_newer_snapshot_is_idempotent(self):
+        """Test a crash between snapshot and journal rewrite loses nothing"""
+        self.store.create('New', 'new@example.com', 'User')
+        self.store.update(3, role='Admin')
+        self.store.delete(2)
+        with open(self.store.journal_path, 'rb') as f:
+            journal = f.read()
+        expected = list(self.store.all())
+        self.store.compact()
+        with open(self.store.journal_path, 'wb') as f:
+            f.write(journal)
+        self.assertEqual(JsonFileStore(self.path).all(), expected)
+    
+    def test_torn_journal_tail_is_ignored(self):
+        """Test a partially written last record does not break loading"""
+        self.store.update(1, name='Renamed')
+        with open(self.store.journal_path, 'ab') as f:
+            f.write(b'{"op": "put", "user": {"id"')
+        reopened = JsonFileStore(self.path)
+        self.assertEqual(reopened.get(1)['name'], 'Renamed')
+        reopened.create('After', 'after@example.com', 'User')
+        self.assertEqual(len(JsonFileStore(self.path).all()), 3)
+    
+    def test_background_compaction_after_threshold(self):
+        """Test the journal is compacted once it passes compact_ops"""
+        store = JsonFileStore(self.path, compact_ops=3)
+        for i in range(3):
+            store.update(1, name='Name %d' % i)
+        for _ in range(100):
+            if not store._compacting:
+                break
+            time.sleep(0.01)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)[0]['name'], 'Name 2')
+    
+    def test_sorted_indexes_follow_writes(self):
+        """Test sorted pages stay correct as records are inserted, updated and deleted"""
+        for name in ['Zed', 'Amy', 'Mia', 'Bob', 'Amy']:
+            self.store.create(name, '%s%d@example.com' % (name, len(self.store.all())), 'User')
+        for field in ('id', 'name', 'email', 'role'):
+            self.store.query(sort_by=field)
+        self.store.update(1, name='Aaron', role='Admin')
+        self.store.delete(4)
+        self.store.create('Nina', 'nina@example.com', 'Manager')
+        for field in ('id', 'name', 'email', 'role'):
+            for order in ('asc', 'desc'):
+                expected = sorted(self.store.all(), key=lambda u: (u[field], u['id']),
+                                  reverse=order == 'desc')
+                rows, total = self.store.query(sort_by=field, order=order)
+                self.assertEqual(rows, expected)
+                self.assertEqual(total, len(expected))
+                rows, _ = self.store.query(sort_by=field, order=order, offset=2, limit=3)
+                self.assertEqual(rows, expected[2:5])
+    
+    def test_keyset_and_top_k_pages_match_full_sort(self):
+        """Test cursor pages and heap-selected pages agree with a full sort"""
+        for i in range(60):
+            self.store.create('Name %02d' % (i % 7), 'user%d@example.com' % i, ['Admin', 'User'][i % 2])
+        for search in ['', 'name 0', 'example']:
+            for field in ('id', 'name', 'role'):
+                for order in ('asc', 'desc'):
+                    expected = [u for u in self.store.all()
+                                if search in u['name'].lower() or search in u['email'].lower()]
+                    expected.sort(key=lambda u: (u[field], u['id']), reverse=order == 'desc')
+                    rows, total = self.store.query(search, field, order, offset=3, limit=2)
+                    self.assertEqual(rows, expected[3:5])
+                    self.assertEqual(total, len(expected))
+                    walked, after = [], None
+                    while True:
+                        rows, _ = self.store.query(search, field, order, limit=4, after=after)
+                        if not rows:
+                            break
+                        walked.extend(rows)
+                        after = (rows[-1][field], rows[-1]['id'])
+                    self.assertEqual(walked, expected)
+    
+    def test_email_index(self):
+        """Test email lookups and the uniqueness check"""
+        self.assertEqual(self.store.get_by_email('TEST2@example.com')['id'], 2)
+        with self.assertRaises(storage.DuplicateEmailError):
+            self.store.create('Dup', 'test1@example.com', 'User')
+        self.store.update(1, email='renamed@example.com')
+        self.assertIsNone(self.store.get_by_email('test1@example.com'))
+        self.store.create('Reuse', 'test1@example.com', 'User')
+    
+    def test_trigram_search_matches_scan(self):
+        """Test indexed search returns exactly the substring matches"""
+        for i, name in enumerate(['Ann Smith', 'Smitty Jones', 'Jo Ann', 'ANNA', 'Zoë Ångström']):
+            self.store.create(name, 'user%d@Example.com' % i, 'User')
+        self.store.update(3, name='Renamed Person')
+        self.store.delete(4)
+        for query in ['ann', 'SMIT', 'mit', 'xyz', 'an', 'a', 'example.com', 'ång', 'user1@', 'renamed p']:
+            expected = [u['id'] for u in self.store.all()
+                        if query.lower() in u['name'].lower() or query.lower() in u['email'].lower()]
+            rows, total = self.store.query(search=query)
+            self.assertEqual([u['id'] for u in rows], expected, query)
+            self.assertEqual(total, len(expected))
+    
+    def test_batch_is_one_durable_write(self):
+        """Test a batch of writes is appended and fsynced once"""
+        ops = [('create', {'name': 'U%d' % i, 'email': 'u%d@example.com' % i, 'role': 'User'})
+               for i in range(50)]
+        ops.append(('update', {'id': 1, 'email': 'u0@example.com'}))
+        ops.append(('delete', 2))
+        with mock.patch('app.storage.os.fsync') as fsync:
+            results = self.store.apply_batch(ops)
+        self.assertEqual(fsync.call_count, 1)
+        self.assertEqual([status for status, _ in results], [201] * 50 + [409, 200])
+        self.assertEqual(len(JsonFileStore(self.path).all()), 51)
+    
+    def test_readers_do_not_wait_for_fsync(self):
+        """Test a read during a slow fsync is answered from memory at once"""
+        self.store.refresh()
+        syncing, release = threading.Event(), threading.Event()
+
+        def slow_fsync(fd):
+            syncing.set()
+            release.wait(5)
+
+        with mock.patch('app.storage.os.fsync', side_effect=slow_fsync):
+            writer = threading.Thread(target=self.store.update, args=(1,), kwargs={'name': 'Durable'})
+            writer.start()
+            try:
+                self.assertTrue(syncing.wait(5))
+                names = []
+                reader = threading.Thread(target=lambda: names.append(self.store.get(1)['name']))
+                reader.start()
+                reader.join(1)
+                self.assertEqual(names, ['Durable'])
+            finally:
+                release.set()
+                writer.join()
+    
+    def test_change_log(self):
+        """Test writes are listed after a version until they fall out of the log"""
+        store = JsonFileStore(self.path, change_log_size=3)
+        since = store.version
+        user = store.create('New', 'new@example.com', 'User')
+        store.update(1, role='User')
+        store.delete(2)
+        changes, has_more = store.changes(since)
+        self.assertFalse(has_more)
+        self.assertEqual([(c['seq'], c['op']) for c in changes],
+                         [(since + 1, 'put'), (since + 2, 'put'), (since + 3, 'delete')])
+        self.assertEqual(changes[0]['user'], user)
+        self.assertTrue(changes[0]['created'])
+        self.assertNotIn('created', changes[1])
+        self.assertEqual(changes[2]['id'], 2)
+        self.assertEqual(store.changes(since, limit=1), (changes[:1], True))
+        self.assertEqual(store.changes(store.version), ([], False))
+        
+        store.create('Newer', 'newer@example.com', 'User')
+        self.assertEqual(store.changes(since + 1)[0], changes[1:] + store.changes(since + 3)[0])
+        with self.assertRaises(ChangeLogGoneError):
+            store.changes(since)
+        with self.assertRaises(ChangeLogGoneError):
+            store.changes(store.version + 1)
+    
+    def test_change_log_follows_other_workers(self):
+        """Test writes made through another store show up once reloaded"""
+        since = self.store.version
+        JsonFileStore(self.path).update(1, name='Elsewhere')
+        changes, _ = self.store.changes(since)
+        self.assertEqual([c['user']['name'] for c in changes], ['Elsewhere'])
+        self.store.replace_all([])
+        with self.assertRaises(ChangeLogGoneError):
+            self.store.changes(since)
+    
+    def test_rewrite_mode(self):
+        """Test journal=False rewrites the snapshot on every write"""
+        store = JsonFileStore(self.path, journal=False)
+        store.update(1, name='Renamed')
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)[0]['name'], 'Renamed')
+        self.assertFalse(os.path.exists(store.journal_path))
+
+@unittest.skipIf(storage.fcntl is None, 'cross-process locking requires fcntl')
+class TestMultiProcessStore(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.json')
+        JsonFileStore(self.path).replace_all([
+            {"id": i + 1, "name": "worker %d" % i, "email": "w%d@example.com" % i, "role": "User"}
+            for i in range(WORKERS)
+        ])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_concurrent_workers_get_unique_ids_and_lose_no_updates(self):
+        """Test concurrent creates and updates from several processes"""
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        procs = [ctx.Process(target=_stress_worker, args=(self.path, w, queue)) for w in range(WORKERS)]
+        for p in procs:
+            p.start()
+        results = dict(queue.get(timeout=60) for _ in procs)
+        for p in procs:
+            p.join(timeout=60)
+            self.assertEqual(p.exitcode, 0)
+        
+        created = [uid for ids in results.values() for uid in ids]
+        self.assertEqual(len(created), WORKERS * WRITES_PER_WORKER)
+        self.assertEqual(len(set(created)), len(created))
+        
+        users = {u['id']: u for u in JsonFileStore(self.path).all()}
+        self.assertEqual(len(users), WORKERS + len(created))
+        for worker, ids in results.items():
+            for uid in ids:
+                self.assertTrue(users[uid]['name'].startswith('w%d-' % worker))
+            # Each thread's last update must be one of the two final writes
+            last = WRITES_PER_WORKER // 2 - 1
+            self.assertIn(users[worker + 1]['name'], [
+                'worker %d thread %d write %d' % (worker, t, last) for t in range(2)
+            ])
+    
+    def test_concurrent_writers_share_a_commit(self):
+        """Test writers arriving together are committed with one fsync"""
+        store = JsonFileStore(self.path, group_commit_window=0.05)
+        store.all()
+        with mock.patch('app.storage.os.fsync') as fsync:
+            threads = [threading.Thread(target=store.create, args=('U%d' % i, 'u%d@example.com' % i, 'User'))
+                       for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(store.all()), WORKERS + 8)
+        self.assertLess(fsync.call_count, 8)
+
+class TestCompactRecords(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.json')
+        JsonFileStore(self.path).replace_all([
+            {"id": i, "name": "User %d" % (i % 7), "email": "u%d@example.com" % i,
+             "role": ['Admin', 'User', 'Manager'][i % 3]}
+            for i in range(1, 41)
+        ])
+        self.store = JsonFileStore(self.path, compact_records=True)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_records_are_slotted_with_interned_roles(self):
+        """Test records are stored compactly but handed out as dicts"""
+        self.store.all()
+        records = list(self.store._users.values())
+        self.assertTrue(all(type(u) is UserRecord for u in records))
+        self.assertIs(records[0].role, records[3].role)
+        self.assertEqual(self.store.get(1), {"id": 1, "name": "User 1", "email": "u1@example.com", "role": "User"})
+        self.assertEqual(self.store.all(), JsonFileStore(self.path).all())
+    
+    def test_queries_match_dict_records(self):
+        """Test search, sort and keyset pages match the dict layout"""
+        plain = JsonFileStore(self.path)
+        for search in ('', 'user 3', 'u1'):
+            for sort_by in ('id', 'name', 'role', 'unknown'):
+                for order in ('asc', 'desc'):
+                    args = (search, sort_by, order, 2, 5)
+                    self.assertEqual(self.store.query(*args), plain.query(*args))
+                    if sort_by != 'unknown':
+                        first = plain.query('', sort_by, order, 7, 1)[0][0]
+                        after = (first[sort_by], first['id'])
+                        self.assertEqual(self.store.query(*args, after=after), plain.query(*args, after=after))
+    
+    def test_writes_and_compaction_keep_the_file_format(self):
+        """Test writes through compact records produce the same files"""
+        user = self.store.create('New', 'new@example.com', 'User')
+        self.assertEqual(self.store.update(user['id'], role='Admin')['role'], 'Admin')
+        self.assertTrue(self.store.delete(2))
+        self.assertEqual(self.store.apply_batch([('update', {'id': 3, 'name': 'Renamed'})])[0][1]['name'], 'Renamed')
+        self.assertTrue(self.store.compact())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), json.dumps(JsonFileStore(self.path).all(), indent=2))
+        self.assertEqual(JsonFileStore(self.path, compact_records=True).all(), self.store.all())
+
+class TestSQLiteStore(unittest.TestCase):
+    
+    def setUp(self):
+        """Migrate a journaled JSON store with awkward sort values into SQLite"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.json = JsonFileStore(os.path.join(self.tmpdir, 'users.json'))
+        self.json.replace_all([
+            {"id": i, "name": name, "email": "u%d@Example.com" % i, "role": role}
+            for i, (name, role) in enumerate([
+                ('bob', 'User'), ('Alice', 'Admin'), ('alice', 'User'), ('Ärger', 'Manager'),
+                ('Bob', 'User'), ('carol', 'Admin'), ('alice', 'Admin')], 1)
+        ])
+        self.json.update(3, name='Alicia')
+        self.path = os.path.join(self.tmpdir, 'users.db')
+        self.assertEqual(migrate(self.json.path, self.path), 7)
+        self.store = SQLiteStore(self.path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_migration_copies_journaled_writes(self):
+        """Test the migration includes writes still in the journal"""
+        self.assertEqual(list(self.store.iter_all()), self.json.all())
+        with self.assertRaises(ValueError):
+            migrate(self.json.path, self.path)
+    
+    def test_migration_requires_the_source(self):
+        """Test a missing source fails instead of replacing the target with nothing"""
+        missing = os.path.join(self.tmpdir, 'missing.json')
+        with self.assertRaises(FileNotFoundError):
+            migrate(missing, self.path, force=True)
+        self.assertEqual(self.store.query(limit=0)[1], 7)
+        other = os.path.join(self.tmpdir, 'other.db')
+        with self.assertRaises(FileNotFoundError):
+            migrate(missing, other)
+        self.assertFalse(os.path.exists(other))
+    
+    def test_queries_match_json_store(self):
+        """Test search, sort, order, offset and keyset pages match the JSON store"""
+        for search in ('', 'ali', 'EXAMPLE', 'zzz'):
+            for sort_by in ('id', 'name', 'email', 'role', 'unknown'):
+                for order in ('asc', 'desc'):
+                    args = (search, sort_by, order)
+                    self.assertEqual(self.store.query(*args, 1, 3), self.json.query(*args, 1, 3), args)
+                    if sort_by != 'unknown':
+                        first = self.json.query('', sort_by, order)[0][1]
+                        after = (first[sort_by], first['id'])
+                        self.assertEqual(self.store.query(*args, 0, 10, after),
+                                         self.json.query(*args, 0, 10, after), args)
+    
+    def test_writes_bump_version(self):
+        """Test writes, email uniqueness and batches behave like the JSON store"""
+        version = self.store.version
+        user = self.store.create('New', 'new@example.com', 'User')
+        self.assertEqual(user['id'], 8)
+        self.assertEqual(self.store.get_by_email('NEW@example.com'), user)
+        with self.assertRaises(ValueError):
+            self.store.create('Dup', 'New@Example.com', 'User')
+        self.assertEqual(self.store.update(8, role='Admin')['role'], 'Admin')
+        self.assertIsNone(self.store.update(99, role='Admin'))
+        self.assertTrue(self.store.delete(8))
+        self.assertFalse(self.store.delete(8))
+        self.assertEqual(self.store.version, version + 3)
+        
+        results = self.store.apply_batch([
+            ('create', {'name': 'A', 'email': 'a@example.com', 'role': 'User'}),
+            ('delete', 99),
+        ], atomic=True)
+        self.assertEqual(results[1][0], 404)
+        self.assertEqual(self.store.version, version + 3)
+        self.assertIsNone(self.store.get_by_email('a@example.com'))
+    
+    def test_change_log(self):
+        """Test changes are grouped by transaction and pruned to the log size"""
+        store = SQLiteStore(self.path, change_log_size=3)
+        since = store.version
+        store.create('New', 'new@example.com', 'User')
+        store.apply_batch([('update', {'id': 1, 'role': 'Admin'}), ('delete', 2)], atomic=True)
+        changes, has_more = store.changes(since)
+        self.assertFalse(has_more)
+        self.assertEqual([(c['seq'], c['op']) for c in changes],
+                         [(since + 1, 'put'), (since + 2, 'put'), (since + 2, 'delete')])
+        self.assertEqual(changes[1]['user']['role'], 'Admin')
+        self.assertTrue(changes[0]['created'])
+        self.assertNotIn('created', changes[1])
+        # One transaction is never split across pages
+        self.assertEqual(store.changes(since, limit=2), (changes[:1], True))
+        
+        store.delete(3)
+        with self.assertRaises(ChangeLogGoneError):
+            store.changes(since)
+        self.assertEqual(store.changes(since + 1)[0][-1], {'seq': since + 3, 'op': 'delete', 'id': 3})
+        store.replace_all([])
+        with self.assertRaises(ChangeLogGoneError):
+            store.changes(since + 3)
+        self.assertEqual(store.changes(store.version), ([], False))
+
+if __name__ == '__main__':
+    unittest.main()